@@ -5,74 +5,2325 @@ import random
 import sys
 import time
 import copy
-import rospy
-import moveit_commander
-import moveit_msgs.msg
-import geometry_msgs.msg
-import inquirer
-from math import pi
-from std_msgs.msg import String
-from moveit_commander.conversions import pose_to_list
-from collections import Counter
+import threading
+import Queue
+import multiprocessing
+import os
+import json
+import csv
+import hashlib
+import sqlite3
+import numpy as np
+from math import pi, sqrt, sin, cos, ceil
+from collections import Counter, OrderedDict
+from multiprocessing.managers import BaseManager
+from multiprocessing.pool import ThreadPool
+
+# ROS / MoveIt take seconds to import, so they are loaded by load_ros()
+# when the MoveIt backend connects rather than at start-up. Without them
+# only the simulated backend can be used.
+rospy = None
+moveit_commander = None
+moveit_msgs = None
+geometry_msgs = None
+shape_msgs = None
+trajectory_msgs = None
+String = None
+pose_to_list = None
+
+
+def load_ros():
+  global rospy, moveit_commander, moveit_msgs, geometry_msgs, shape_msgs, trajectory_msgs
+  global String, pose_to_list
+  if moveit_commander is not None:
+      return
 
+  import rospy
+  import moveit_msgs.msg
+  import moveit_msgs.srv
+  import geometry_msgs.msg
+  import shape_msgs.msg
+  import trajectory_msgs.msg
+  from std_msgs.msg import String
+  from moveit_commander.conversions import pose_to_list
+  # last, so a partial import is retried next time
+  import moveit_commander
+
+
+class NoException(Exception):
+  """NoException"""
+  ## Never raised; stands in for rospy's exceptions before rospy is loaded.
+
+
+def ros_interrupt():
+  if rospy is None:
+      return NoException
+  return rospy.ROSInterruptException
+
+
+class Span(object):
+  """Span"""
+  ## One timed stage; recorded as a Chrome trace "complete" event when the
+  ## `with` block exits. set() attaches values known only at the end.
+  def __init__(self, tracer, name, args):
+      self.tracer = tracer
+      self.name = name
+      self.args = args
+
+  def set(self, **args):
+      self.args.update(args)
+
+  def __enter__(self):
+      self.start = time.time()
+      return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+      end = time.time()
+      if exc_type is not None:
+          self.args['error'] = exc_type.__name__
+      self.tracer.record(self.name, self.start, end, self.args)
+      return False
+
+
+class NullSpan(object):
+  """NullSpan"""
+  ## Returned while tracing is off: no clock reads, nothing stored.
+  def set(self, **args):
+      return
 
+  def __enter__(self):
+      return self
 
+  def __exit__(self, exc_type, exc_value, traceback):
+      return False
 
-class HouseholdPandaArm(object):
-  """HouseholdPandaArm"""
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer(object):
+  """Tracer"""
+  ## Span instrumentation for the stages of a sort, exported in the Chrome
+  ## trace event format (chrome://tracing, ui.perfetto.dev). Disabled by
+  ## default, in which case span() hands back a shared no-op span.
   def __init__(self):
-    super(HouseholdPandaArm, self).__init__()
+      self.enabled = False
+      self.events = []
+      self.lock = threading.Lock()
+      self.origin = time.time()
+
+  def enable(self):
+      self.events = []
+      self.origin = time.time()
+      self.enabled = True
+
+  def disable(self):
+      self.enabled = False
+
+  def span(self, name, **args):
+      if not self.enabled:
+          return NULL_SPAN
+      return Span(self, name, args)
+
+  def record(self, name, start, end, args):
+      event = {
+          'name': name,
+          'cat': name.split('.')[0],
+          'ph': 'X',
+          'ts': (start - self.origin) * 1e6,
+          'dur': (end - start) * 1e6,
+          'pid': os.getpid(),
+          'tid': threading.current_thread().ident,
+          'args': args,
+      }
+      # racing planners record from several threads
+      with self.lock:
+          self.events.append(event)
+
+  def summary(self):
+      # stage name -> (count, total seconds), slowest stage first
+      totals = {}
+      for event in self.events:
+          count, seconds = totals.get(event['name'], (0, 0.0))
+          totals[event['name']] = (count + 1, seconds + event['dur'] / 1e6)
+
+      return sorted(totals.items(), key=lambda item: -item[1][1])
 
-    ## BEGIN setup
-    ##
-    ## First initialize `moveit_commander`_ and a `rospy`_ node:
-    moveit_commander.roscpp_initialize(sys.argv)
-    rospy.init_node('PANDA_TABLE', anonymous=True)
+  def export(self, path):
+      with open(path, 'w') as f:
+          json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+
+tracer = Tracer()
+
+
+# Cartesian planning parameters shared by every leg
+EEF_STEP = 0.01
+JUMP_THRESHOLD = 0
+
+
+class PlanCache(object):
+  """PlanCache"""
+  def __init__(self, max_entries=64, resolution=0.005):
+      # plans are kept in least-recently-used order, oldest first
+      self.max_entries = max_entries
+      self.resolution = resolution
+      self.entries = OrderedDict()
+      self.scene_state = None
+      self.hits = 0
+      self.misses = 0
 
-    ## Instantiate a `RobotCommander`_ object. Provides information such as the robot's
-    ## kinematic model and the robot's current joint states
-    robot = moveit_commander.RobotCommander()
+  def quantize(self, pose):
+      res = self.resolution
+      p = pose.position
+      o = pose.orientation
+      values = (p.x, p.y, p.z, o.x, o.y, o.z, o.w)
+
+      return tuple(int(round(v / res)) for v in values)
+
+  def make_key(self, start_pose, waypoints, eef_step, obj_attached):
+      quantized_waypoints = tuple(self.quantize(wp) for wp in waypoints)
+
+      return (self.scene_state, self.quantize(start_pose), quantized_waypoints, eef_step, bool(obj_attached))
+
+  def get(self, key):
+      if key not in self.entries:
+          self.misses += 1
+          return None
+
+      # re-insert to mark as most recently used
+      plan = self.entries.pop(key)
+      self.entries[key] = plan
+      self.hits += 1
+
+      return plan
+
+  def put(self, key, plan):
+      if key in self.entries:
+          self.entries.pop(key)
+      self.entries[key] = plan
+
+      while len(self.entries) > self.max_entries:
+          self.entries.popitem(last=False)
+
+  def discard(self, key):
+      self.entries.pop(key, None)
+
+  def set_scene(self, scene_state):
+      # plans are only valid for the scene they were computed in, so the
+      # scene state is part of every key. Returning to an earlier scene
+      # (e.g. the same layout in the next episode) can reuse its plans.
+      self.scene_state = scene_state
+
+  def invalidate(self):
+      self.entries.clear()
+
+  def report(self):
+      total = self.hits + self.misses
+      if total == 0:
+          return "Plan cache: no lookups"
+      rate = 100.0 * self.hits / total
+
+      return "Plan cache: {} hits, {} misses ({:.1f}% hit rate)".format(self.hits, self.misses, rate)
+
+
+plan_cache = PlanCache()
+
+
+def straight_path(corners, step):
+  ## Points every `step` or less along the straight lines through the
+  ## (K, D) `corners`, starting with the first corner and ending on the
+  ## last one.
+  corners = np.asarray(corners, dtype=float)
+  if len(corners) < 2:
+      return corners.copy()
+  lengths = np.sqrt((np.diff(corners, axis=0) ** 2).sum(axis=1))
+  steps = np.maximum(1, np.ceil(lengths / step).astype(int))
 
-    ## Instantiate a `PlanningSceneInterface`_ object.  This provides a remote interface
-    ## for getting, setting, and updating the robot's internal understanding of the
-    ## surrounding world:
-    scene = moveit_commander.PlanningSceneInterface()
+  # segment of every point, and how far along it the point is
+  segment = np.repeat(np.arange(len(steps)), steps)
+  taken = np.arange(steps.sum()) - np.repeat(np.cumsum(steps) - steps, steps) + 1
+  t = taken / steps[segment].astype(float)
+  path = corners[segment] + (corners[segment + 1] - corners[segment]) * t[:, None]
 
-    ## Instantiate a `MoveGroupCommander`_ object.  This object is an interface
-    ## to a planning group (group of joints).  In this program the group is the primary
-    ## arm joints in the Panda robot, so we set the group's name to "panda_arm".
-    ## This interface can be used to plan and execute motions:
-    group_name = "panda_arm"
-    move_group = moveit_commander.MoveGroupCommander(group_name)
+  return np.vstack((corners[:1], path))
 
-    ## Create a `DisplayTrajectory`_ ROS publisher which is used to display
-    ## trajectories in Rviz:
-    display_trajectory_publisher = rospy.Publisher('/move_group/display_planned_path',
-                                                   moveit_msgs.msg.DisplayTrajectory,
-                                                   queue_size=20)
 
+def box_collisions(points, boxes, held=()):
+  ## Which of the (N, 3) gripper positions put the tip, or any held
+  ## object, inside one of the (xyz, dims) `boxes`. Held objects are
+  ## (offset from the gripper, dims). Boxes that only touch (within a
+  ## small tolerance) do not collide.
+  tolerance = 1e-6
+  hit = np.zeros(len(points), dtype=bool)
+  for xyz, dims in boxes:
+      centre = np.asarray(xyz, dtype=float)
+      reach = np.asarray(dims, dtype=float) / 2 - tolerance
+      hit |= (np.abs(points - centre) < reach).all(axis=1)
 
-    ##
-    ## Getting Basic Information
-    ## ^^^^^^^^^^^^^^^^^^^^^^^^^
-    # We can get the name of the reference frame for this robot:
-    planning_frame = move_group.get_planning_frame()
-    #print "============ Planning frame: %s" % planning_frame
+      for offset, held_dims in held:
+          held_reach = reach + np.asarray(held_dims, dtype=float) / 2
+          hit |= (np.abs(points + np.asarray(offset, dtype=float) - centre) < held_reach).all(axis=1)
+
+  return hit
+
+
+# Where the trajectory library is kept unless --library says otherwise
+TRAJECTORY_LIBRARY_PATH = os.path.expanduser('~/.household_panda_trajectories')
 
-    # We can also print the name of the end-effector link for this group:
-    eef_link = move_group.get_end_effector_link()
-    #print "============ End effector link: %s" % eef_link
 
-    # We can get a list of all the groups in the robot:
-    group_names = robot.get_group_names()
-    #print "============ Available Planning Groups:", robot.get_group_names()
+class TrajectoryLibrary(object):
+  """TrajectoryLibrary"""
+  ## Joint trajectories planned offline between canonical poses (the EASY
+  ## goals, the ready pose and home), keyed like the plan cache but without
+  ## the scene. On disk a library is a directory of three .npy files:
+  ## index.npy (key digest, first point, point count, whether an object is
+  ## held), points.npy (float32
+  ## rows of joint positions and time) and joints.npy (joint names). The
+  ## points are memory-mapped, so opening a library reads only the index.
+  ## A stored leg is only replayed if its straight lines stay clear of
+  ## the current scene.
+  def __init__(self):
+      self.entries = {}
+      # key digest -> whether the leg carries an object, None for libraries
+      # saved without the flag
+      self.attached = {}
+      self.points = None
+      self.joint_names = []
+      self.backend = None
+      self.recorded = []
+      self.hits = 0
+      self.rejected = 0
+
+  def digest(self, cache_key):
+      # the plan cache key without the scene state
+      return hashlib.md5(repr(cache_key[1:])).hexdigest()
+
+  def open(self, path):
+      index = np.load(os.path.join(path, 'index.npy'))
+      self.points = np.load(os.path.join(path, 'points.npy'), mmap_mode='r')
+      self.joint_names = [str(name) for name in np.load(os.path.join(path, 'joints.npy'))]
+      self.entries = dict((str(row['key']), (int(row['start']), int(row['count']))) for row in index)
+      if 'attached' in index.dtype.names:
+          self.attached = dict((str(row['key']), bool(row['attached'])) for row in index)
+      else:
+          self.attached = dict((key, None) for key in self.entries)
+
+  def lookup(self, cache_key, start_pose, waypoints, scene_state):
+      ## Stored trajectory for the leg, or None if there is none or it would
+      ## run into something in `scene_state`.
+      entry = self.entries.get(self.digest(cache_key))
+      if entry is None or self.backend is None:
+          return None
+      if not self.clear(start_pose, waypoints, scene_state):
+          self.rejected += 1
+          return None
+
+      start, count = entry
+      block = np.asarray(self.points[start:start + count], dtype=float)
+      self.hits += 1
+
+      return self.backend.trajectory_from(self.joint_names, block[:, :-1], block[:, -1])
+
+  def discard(self, cache_key):
+      # e.g. refused by the controller, not offered again in this run
+      self.entries.pop(self.digest(cache_key), None)
+
+  def clear(self, start_pose, waypoints, scene_state, step=0.01):
+      ## Whether the gripper tip, and the held object, stay out of the world
+      ## boxes along the straight lines through the waypoints. Without a
+      ## known scene nothing counts as clear.
+      if scene_state is None:
+          return False
+      world, held = scene_state
 
-    # Sometimes for debugging it is useful to print the entire state of the
-    # robot:
-    #print "============ Printing robot state"
-    #print robot.get_current_state()
-    print ""
+      corners = np.array([(pose.position.x, pose.position.y, pose.position.z)
+                          for pose in [start_pose] + list(waypoints)], dtype=float)
+      path = straight_path(corners, step)
+
+      boxes = dict(world)
+      held_boxes = []
+      if held is not None:
+          held_xyz, held_dims = boxes.pop(held)
+          held_boxes.append((np.asarray(held_xyz, dtype=float) - corners[0], held_dims))
+
+      return not box_collisions(path, boxes.values(), held_boxes).any()
+
+  def record(self, cache_key, plan, joint_names):
+      self.joint_names = list(joint_names)
+      positions = trajectory_positions(plan)
+      # the last part of a plan cache key is whether an object is held
+      self.recorded.append((self.digest(cache_key), np.column_stack((positions, trajectory_times(plan))),
+                            cache_key[-1]))
+
+  def save(self, path):
+      if not os.path.isdir(path):
+          os.makedirs(path)
+
+      index = np.zeros(len(self.recorded),
+                       dtype=[('key', 'S32'), ('start', '<i8'), ('count', '<i4'), ('attached', '?')])
+      start = 0
+      for k, (key, rows, attached) in enumerate(self.recorded):
+          index[k] = (key, start, len(rows), attached)
+          start += len(rows)
+      points = np.vstack([rows for key, rows, attached in self.recorded]).astype(np.float32)
+
+      np.save(os.path.join(path, 'points.npy'), points)
+      np.save(os.path.join(path, 'joints.npy'), np.array(self.joint_names, dtype='S64'))
+      # the index goes last, a library without one is never opened
+      np.save(os.path.join(path, 'index.npy'), index)
+
+  def report(self):
+      return "Trajectory library: {} legs, {} replayed, {} blocked by the scene".format(
+          len(self.entries), self.hits, self.rejected)
+
+
+trajectory_library = TrajectoryLibrary()
+
+
+# Timeouts (seconds) and tolerance used while waiting on the scene and the
+# controller instead of sleeping for a fixed time
+SCENE_TIMEOUT = 4.0
+SETTLE_TIMEOUT = 2.0
+JOINT_TOLERANCE = 0.01
+
+
+def wait_for(condition, timeout, poll=0.02):
+  ## Poll `condition` until it holds or `timeout` runs out. Returns whether
+  ## the condition was met, so callers decide how to handle a timeout.
+  deadline = time.time() + timeout
+  while True:
+      if condition():
+          return True
+      if time.time() >= deadline:
+          return False
+      time.sleep(poll)
+
+
+class SceneBatch(object):
+  """SceneBatch"""
+  ## Collects box additions, attaches, detaches and removals, and applies
+  ## them to the planning scene as one diff when the `with` block exits.
+  def __init__(self, arm):
+      self.arm = arm
+      self.boxes = []
+      self.removals = []
+      self.attaches = []
+      self.detaches = []
+
+  def add_box(self, obj_name, obj_xyz, obj_dims):
+      self.boxes.append((obj_name, tuple(obj_xyz), tuple(obj_dims)))
+
+  def remove(self, obj_name):
+      self.removals.append(obj_name)
+
+  def attach_box(self, obj_name):
+      self.attaches.append(obj_name)
+
+  def detach_box(self, obj_name, obj_xyz):
+      # obj_xyz is where the object is left, for the local world mirror
+      self.detaches.append((obj_name, tuple(obj_xyz)))
+
+  def commit(self):
+      with tracer.span('scene.apply_batch', boxes=len(self.boxes), attaches=len(self.attaches),
+                       detaches=len(self.detaches), removals=len(self.removals)):
+          return self.arm.apply_scene_batch(self)
+
+  def __enter__(self):
+      return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+      if exc_type is None:
+          self.commit()
+      return False
+
+
+def wait_for_goal_reached(move_group, plan, timeout=SETTLE_TIMEOUT):
+  points = plan.joint_trajectory.points
+  if not points:
+      return True
+  goal = points[-1].positions
+
+  def reached():
+      current = move_group.get_current_joint_values()
+      for c, g in zip(current, goal):
+          if abs(c - g) > JOINT_TOLERANCE:
+              return False
+      return True
+
+  return wait_for(reached, timeout)
+
+
+class PoseTracker(object):
+  """PoseTracker"""
+  ## Locally tracked end-effector pose. After each executed leg the arm is
+  ## where the last waypoint asked it to be (wait_for_goal_reached checks
+  ## that within JOINT_TOLERANCE), so the next leg can start from that
+  ## instead of querying move_group. The pose is read from the robot only
+  ## when it is unknown: at start-up, after a failed or rejected execution,
+  ## or when the arm did not settle.
+  def __init__(self, move_group):
+      self.move_group = move_group
+      self.tracked = None
+      self.syncs = 0
+      self.reuses = 0
+
+  def pose(self):
+      # a copy, callers build waypoints by editing it
+      if self.tracked is None:
+          self.sync()
+      else:
+          self.reuses += 1
+
+      return copy.deepcopy(self.tracked)
+
+  def sync(self):
+      self.tracked = self.move_group.get_current_pose().pose
+      self.syncs += 1
+
+  def update(self, pose):
+      self.tracked = copy.deepcopy(pose)
+
+  def invalidate(self):
+      self.tracked = None
+
+
+# 'sequential' retries the same Cartesian request, 'race' runs the
+# strategies below in parallel and keeps the first full path
+PLANNING_MODE = 'sequential'
+
+# 'legs' moves each object with separate approach and transport motions,
+# 'stitched' plans both and runs them as one blended trajectory,
+# 'pipelined' runs separate legs but plans each one while the previous
+# one executes
+MOTION_MODE = 'legs'
+
+# (eef_step, jump_threshold, mode) for each racing attempt
+PLANNING_STRATEGIES = [
+    (0.01, 0.0, 'cartesian'),
+    (0.005, 0.0, 'cartesian'),
+    (0.02, 0.0, 'cartesian'),
+    (0.01, 5.0, 'cartesian'),
+    (EEF_STEP, JUMP_THRESHOLD, 'joint'),
+]
+
+
+class PlanningRace(object):
+  """PlanningRace"""
+  def __init__(self, strategies=PLANNING_STRATEGIES, timeout=30.0):
+      self.strategies = strategies
+      self.timeout = timeout
+      # joint-space planning goes through the group's pose target, which
+      # only one attempt may own at a time
+      self.joint_lock = threading.Lock()
+      self.workers = []
+
+  def drain(self):
+      ## Waits for attempts that were still planning when their race ended.
+      for worker in self.workers:
+          worker.join()
+      self.workers = []
+
+  def plan_with(self, move_group, waypoints, strategy, cancelled):
+      eef_step, jump_threshold, mode = strategy
+
+      if mode == 'cartesian':
+          return move_group.compute_cartesian_path(waypoints, eef_step, jump_threshold, True)
+
+      # joint-space fallback straight to the final waypoint
+      with self.joint_lock:
+          # a race that was decided while this attempt waited for the lock
+          # must not touch the group's pose target any more
+          if cancelled.is_set():
+              return (None, 0.0)
+          move_group.set_pose_target(waypoints[-1])
+          result = move_group.plan()
+          move_group.clear_pose_targets()
+
+      # melodic returns the trajectory, noetic a (success, trajectory, ...) tuple
+      if isinstance(result, tuple):
+          success, plan = result[0], result[1]
+      else:
+          plan = result
+          success = len(plan.joint_trajectory.points) > 0
+
+      if success:
+          return (plan, 1.0)
+      else:
+          return (plan, 0.0)
+
+  def run_attempt(self, move_group, waypoints, strategy, results, cancelled):
+      if cancelled.is_set():
+          return
+      try:
+          with tracer.span('planning.race_attempt', strategy=str(strategy)) as span:
+              (plan, fraction) = self.plan_with(move_group, waypoints, strategy, cancelled)
+              span.set(fraction=fraction)
+      except Exception as e:
+          print("Planning strategy " + str(strategy) + " failed: " + str(e))
+          (plan, fraction) = (None, 0.0)
+      results.put((plan, fraction, strategy))
+
+  def race(self, move_group, waypoints, maxtries):
+      ## Runs every strategy once. The strategies are deterministic, so a
+      ## second round would only repeat the same answers; the caller's
+      ## retry loop takes over when no attempt found the full path.
+      best_plan = None
+      best_fraction = 0.0
+      attempts = 0
+
+      results = Queue.Queue()
+      cancelled = threading.Event()
+      strategies = self.strategies[:maxtries]
+      for strategy in strategies:
+          worker = threading.Thread(target=self.run_attempt,
+                                    args=(move_group, waypoints, strategy, results, cancelled))
+          # losing attempts are cancelled below and left to finish in the
+          # background if they already started planning
+          worker.daemon = True
+          worker.start()
+          self.workers.append(worker)
+      self.workers = [w for w in self.workers if w.is_alive()]
+
+      try:
+          deadline = time.time() + self.timeout
+          for i in range(len(strategies)):
+              try:
+                  (plan, fraction, strategy) = results.get(timeout=max(0.0, deadline - time.time()))
+              except Queue.Empty:
+                  # nothing more came back before the deadline
+                  break
+              attempts += 1
+
+              if fraction > best_fraction or best_plan is None:
+                  best_plan = plan
+                  best_fraction = fraction
+              if fraction == 1.0:
+                  break
+      finally:
+          cancelled.set()
+
+      return (best_plan, best_fraction, attempts)
+
+
+planning_race = PlanningRace()
+
+
+class PendingPlan(object):
+  """PendingPlan"""
+  def __init__(self):
+      self.done = threading.Event()
+      self.plan = None
+      self.fraction = 0.0
+
+  def result(self):
+      self.done.wait()
+      return self.plan, self.fraction
+
+
+class PlanningPipeline(object):
+  """PlanningPipeline"""
+  ## Plans a leg on a worker thread, from a predicted start state, while
+  ## the arm is still executing the previous one. Only one leg is planned
+  ## at a time since the start state belongs to the whole group.
+  def __init__(self, move_group, maxtries=10):
+      self.move_group = move_group
+      self.maxtries = maxtries
+      self.lock = threading.Lock()
+
+  def submit(self, waypoints, start_state):
+      pending = PendingPlan()
+      worker = threading.Thread(target=self.run, args=(waypoints, start_state, pending))
+      worker.daemon = True
+      worker.start()
+
+      return pending
+
+  def run(self, waypoints, start_state, pending):
+      move_group = self.move_group
+      with self.lock:
+          try:
+              with tracer.span('planning.pipelined') as span:
+                  move_group.set_start_state(start_state)
+                  attempts = 0
+                  while pending.fraction < 1.0 and attempts < self.maxtries:
+                      (pending.plan, pending.fraction) = move_group.compute_cartesian_path(
+                          waypoints, EEF_STEP, JUMP_THRESHOLD, True)
+                      attempts += 1
+                  span.set(fraction=pending.fraction, attempts=attempts)
+          except Exception as e:
+              print("Pipelined planning failed: " + str(e))
+              pending.fraction = 0.0
+          finally:
+              move_group.set_start_state_to_current_state()
+              pending.done.set()
+
+
+class StandInPlan(object):
+  """StandInPlan"""
+  def __init__(self, waypoints, strategy):
+      self.waypoints = waypoints
+      self.strategy = strategy
+
+
+class StandInPlanner(object):
+  """StandInPlanner"""
+  ## Local replacement for the planning calls of a MoveGroupCommander, so
+  ## planning modes can be compared without ROS. Finer steps take longer,
+  ## and every strategy has its own chance of finding the full path.
+  def __init__(self, latency=0.05, success_rates=None, seed=None):
+      self.latency = latency
+      if success_rates is None:
+          success_rates = {'cartesian': 0.3, 'jump': 0.5, 'joint': 0.8}
+      self.success_rates = success_rates
+      self.rng = random.Random(seed)
+      self.rng_lock = threading.Lock()
+      self.calls = 0
+
+  def roll(self, rate):
+      with self.rng_lock:
+          self.calls += 1
+          return self.rng.random() < rate
+
+  def compute_cartesian_path(self, waypoints, eef_step, jump_threshold, avoid_collisions=True):
+      time.sleep(self.latency * (EEF_STEP / eef_step))
+
+      if jump_threshold > 0:
+          rate = self.success_rates['jump']
+      else:
+          rate = self.success_rates['cartesian']
+
+      if self.roll(rate):
+          return (StandInPlan(waypoints, 'cartesian'), 1.0)
+      else:
+          with self.rng_lock:
+              fraction = float("%.2f" % self.rng.uniform(0.0, 0.99))
+          return (StandInPlan(waypoints, 'cartesian'), fraction)
+
+  def set_pose_target(self, pose):
+      self.pose_target = pose
+
+  def clear_pose_targets(self):
+      self.pose_target = None
+
+  def plan(self):
+      # sampling-based planners are noticeably slower than a Cartesian step
+      time.sleep(self.latency * 3)
+      success = self.roll(self.success_rates['joint'])
+
+      return (success, StandInPlan([self.pose_target], 'joint'), self.latency * 3, None)
+
+
+def benchmark_planning_race(legs=50, seed=0):
+  ## Compare the sequential retry loop against the parallel race on the
+  ## stand-in planner, with the same random sequence for both modes.
+  maxtries = 10
+  waypoints = [None, None, None]
+
+  for mode in ['sequential', 'race']:
+    planner = StandInPlanner(seed=seed)
+    race = PlanningRace()
+    times = []
+    failures = 0
+
+    for leg in range(legs):
+        start = time.time()
+        fraction = 0.0
+        attempts = 0
+        if mode == 'race':
+            (plan, fraction, attempts) = race.race(planner, waypoints, maxtries)
+        # the race falls back to the retry loop just like plan_move does
+        while fraction < 1.0 and attempts < maxtries:
+            (plan, fraction) = planner.compute_cartesian_path(waypoints, EEF_STEP, JUMP_THRESHOLD, True)
+            attempts += 1
+        times.append(time.time() - start)
+        if fraction < 1.0:
+            failures += 1
+    race.drain()
+
+    times.sort()
+    print("{:<10} mean {:.3f}s  median {:.3f}s  max {:.3f}s  failed legs {}/{}  planner calls {}".format(
+        mode, sum(times) / len(times), times[len(times) // 2], times[-1], failures, legs, planner.calls))
+
+
+# Tableware on the table: name, default (x, y) and depth along x. All of
+# them share the same width and height (obj_width, obj_height).
+TABLEWARE = [
+    ("plate", (0.4, 0), 0.12),
+    ("knife", (0.4, -0.2), 0.08),
+    ("fork", (0.4, 0.2), 0.04),
+]
+
+
+class ObjectRegistry(object):
+  """ObjectRegistry"""
+  ## Struct-of-arrays store for the tableware. Each object is one row of
+  ## contiguous position / size / state arrays, found by name through a
+  ## dict, so lookups are index operations and a new kind of object is a
+  ## new row rather than new attributes.
+  def __init__(self, capacity=8):
+      self.names = []
+      self.rows = {}
+      self.positions = np.zeros((capacity, 3))
+      self.sizes = np.zeros((capacity, 3))
+      self.attached = np.zeros(capacity, dtype=bool)
+
+  def __len__(self):
+      return len(self.names)
+
+  def __contains__(self, obj_name):
+      return obj_name in self.rows
+
+  def __iter__(self):
+      return iter(self.names)
+
+  def add(self, obj_name, xyz, size):
+      count = len(self.names)
+      if count == len(self.attached):
+          # double the capacity, keeping the arrays contiguous
+          self.positions = np.concatenate((self.positions, np.zeros_like(self.positions)))
+          self.sizes = np.concatenate((self.sizes, np.zeros_like(self.sizes)))
+          self.attached = np.concatenate((self.attached, np.zeros_like(self.attached)))
+
+      self.rows[obj_name] = count
+      self.names.append(obj_name)
+      self.positions[count] = xyz
+      self.sizes[count] = size
+
+      return count
+
+  def get_xy(self, obj_name):
+      row = self.rows[obj_name]
+      return (float(self.positions[row, 0]), float(self.positions[row, 1]))
+
+  def get_xyz(self, obj_name):
+      return tuple(float(v) for v in self.positions[self.rows[obj_name]])
+
+  def set_xy(self, obj_name, xy):
+      self.positions[self.rows[obj_name], :2] = xy[:2]
+
+  def get_size(self, obj_name):
+      return tuple(float(v) for v in self.sizes[self.rows[obj_name]])
+
+  def footprint(self, obj_name):
+      # half extents on the table; like the original intersect_check the
+      # full width is used on either side in y, leaving a safety margin
+      row = self.rows[obj_name]
+      return (float(self.sizes[row, 0]) / 2, float(self.sizes[row, 1]))
+
+  def set_attached(self, obj_name, attached):
+      self.attached[self.rows[obj_name]] = attached
+
+
+class FootprintGrid(object):
+  """FootprintGrid"""
+  ## Uniform grid over the table holding each object's footprint in every
+  ## cell it touches. A query only looks at the objects registered in the
+  ## cells under the query rectangle, so checks stay cheap however many
+  ## objects are on the table.
+  def __init__(self, cell_size=0.1):
+      self.cell_size = cell_size
+      self.cells = {}
+      # name -> ((x, y), (half depth, half width), cells)
+      self.entries = {}
+
+  def cells_for(self, xy, half):
+      size = self.cell_size
+      first_i = int((xy[0] - half[0]) // size)
+      last_i = int((xy[0] + half[0]) // size)
+      first_j = int((xy[1] - half[1]) // size)
+      last_j = int((xy[1] + half[1]) // size)
+
+      return [(i, j) for i in range(first_i, last_i + 1) for j in range(first_j, last_j + 1)]
+
+  def insert(self, obj_name, xy, half):
+      if obj_name in self.entries:
+          self.remove(obj_name)
+
+      cells = self.cells_for(xy, half)
+      for cell in cells:
+          self.cells.setdefault(cell, set()).add(obj_name)
+      self.entries[obj_name] = (tuple(xy[:2]), tuple(half), cells)
+
+  def remove(self, obj_name):
+      xy, half, cells = self.entries.pop(obj_name)
+      for cell in cells:
+          members = self.cells[cell]
+          members.discard(obj_name)
+          if not members:
+              del self.cells[cell]
+
+  def move(self, obj_name, xy):
+      half = self.entries[obj_name][1]
+      self.insert(obj_name, xy, half)
+
+  def position(self, obj_name):
+      return self.entries[obj_name][0]
+
+  def half_extents(self, obj_name):
+      return self.entries[obj_name][1]
+
+  def arrays(self, exclude=None):
+      # positions and half extents as (M, 2) arrays for batch checks
+      names = [name for name in self.entries if name != exclude]
+      positions = np.array([self.entries[name][0] for name in names], dtype=float).reshape(-1, 2)
+      half_extents = np.array([self.entries[name][1] for name in names], dtype=float).reshape(-1, 2)
+
+      return positions, half_extents
+
+  def query(self, xy, half, exclude=None):
+      ## Names of the objects whose footprint overlaps the rectangle of
+      ## half extents `half` centred on `xy`.
+      candidates = set()
+      for cell in self.cells_for(xy, half):
+          candidates.update(self.cells.get(cell, ()))
+      candidates.discard(exclude)
+
+      hits = []
+      for obj_name in candidates:
+          other_xy, other_half, cells = self.entries[obj_name]
+          overlap_x = intersection((xy[0] - half[0], xy[0] + half[0]),
+                                   (other_xy[0] - other_half[0], other_xy[0] + other_half[0]))
+          overlap_y = intersection((xy[1] - half[1], xy[1] + half[1]),
+                                   (other_xy[1] - other_half[1], other_xy[1] + other_half[1]))
+          if overlap_x > 0 and overlap_y > 0:
+              hits.append(obj_name)
+
+      return hits
+
+
+def batch_placement_check(candidates, half, positions, half_extents):
+  ## Tests many candidate centres for a footprint of half extents `half`
+  ## in one vectorised pass. candidates is (N, 2); positions and
+  ## half_extents are (M, 2) for the objects already on the table. Returns
+  ## a boolean mask of the collision-free candidates and each candidate's
+  ## clearance: the gap to the nearest footprint, or minus the shorter
+  ## overlap when it overlaps one.
+  candidates = np.asarray(candidates, dtype=float).reshape(-1, 2)
+  positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+  half_extents = np.asarray(half_extents, dtype=float).reshape(-1, 2)
+
+  if len(positions) == 0:
+      return np.ones(len(candidates), dtype=bool), np.full(len(candidates), np.inf)
+
+  # (N, M, 2) per-axis interval overlaps, computed exactly like
+  # `intersection` so both checks agree on footprints that only touch
+  half = np.asarray(half, dtype=float)
+  low = np.maximum((candidates - half)[:, None, :], (positions - half_extents)[None, :, :])
+  high = np.minimum((candidates + half)[:, None, :], (positions + half_extents)[None, :, :])
+  overlap = high - low
+
+  colliding = (overlap > 0).all(axis=2)
+  separated = np.maximum(-overlap, 0.0)
+  distance = np.sqrt((separated ** 2).sum(axis=2))
+  pair_clearance = np.where(colliding, -overlap.min(axis=2), distance)
+
+  mask = ~colliding.any(axis=1)
+  clearance = pair_clearance.min(axis=1)
+
+  return mask, clearance
+
+
+class OccupancyMap(object):
+  """OccupancyMap"""
+  ## Grid of candidate centre points (2 d.p., like every other coordinate
+  ## here) inside the table bounds minus a margin. All centres are checked
+  ## against the footprints in one batch and the free ones ranked by
+  ## distance. The search is a fixed amount of work, so it always finishes
+  ## and returns None when the table is full.
+  def __init__(self, bounds, margins, resolution=0.01):
+      lower_x, upper_x, lower_y, upper_y = bounds
+      margin_x, margin_y = margins
+      steps_x = int(round(((upper_x - margin_x) - (lower_x + margin_x)) / resolution))
+      steps_y = int(round(((upper_y - margin_y) - (lower_y + margin_y)) / resolution))
+
+      xs = [float("%.2f" % (lower_x + margin_x + i * resolution)) for i in range(steps_x + 1)]
+      ys = [float("%.2f" % (lower_y + margin_y + j * resolution)) for j in range(steps_y + 1)]
+      grid_x, grid_y = np.meshgrid(xs, ys, indexing='ij')
+      self.centres = np.column_stack((grid_x.ravel(), grid_y.ravel()))
+      # centres that may be offered at all, e.g. the ones within reach
+      self.allowed = None
+
+  def restrict(self, allowed):
+      self.allowed = allowed
+
+  def free_mask(self, half, index, exclude=None):
+      positions, half_extents = index.arrays(exclude)
+      mask, clearance = batch_placement_check(self.centres, half, positions, half_extents)
+      if self.allowed is not None:
+          mask &= self.allowed
+
+      return mask
+
+  def nearest_free(self, half, index, preferred, exclude=None, cost=None):
+      ## Closest free centre to `preferred` for a footprint of half extents
+      ## `half`, or None if there is no space left. `cost`, if given, maps
+      ## the (K, 2) free centres to what is minimised instead of distance.
+      free = self.centres[self.free_mask(half, index, exclude)]
+      if len(free) == 0:
+          return None
+
+      # ties are broken on x then y so the result is deterministic
+      if cost is not None:
+          dist = np.round(cost(free), 9)
+      else:
+          dist = ((free - np.asarray(preferred[:2], dtype=float)) ** 2).sum(axis=1)
+      best = np.lexsort((free[:, 1], free[:, 0], dist))[0]
+
+      return (float(free[best, 0]), float(free[best, 1]))
+
+
+# Reachability maps made in this process, by backend and grid
+reachability_maps = {}
+
+# Where a real robot's reachability map is kept, by backend name
+REACHABILITY_PATH = os.path.expanduser('~/.household_panda_reach_{}.npz')
+
+
+class ReachabilityMap(object):
+  """ReachabilityMap"""
+  ## Which points of a grid over the table (2 d.p.) the gripper can reach
+  ## at every height it works at. Computed once per robot; lookups are
+  ## O(1) and points off the grid are out of reach.
+  def __init__(self, bounds, heights, resolution=0.01):
+      lower_x, upper_x, lower_y, upper_y = bounds
+      self.bounds = tuple(bounds)
+      self.heights = tuple(heights)
+      self.resolution = resolution
+      self.steps = (int(round((upper_x - lower_x) / resolution)) + 1,
+                    int(round((upper_y - lower_y) / resolution)) + 1)
+      self.mask = None
+
+  def compute(self, reachable_points):
+      ## `reachable_points` maps an (N, 3) array of positions to N booleans;
+      ## it gets every grid point at every height in one call.
+      xs = np.round(self.bounds[0] + np.arange(self.steps[0]) * self.resolution, 2)
+      ys = np.round(self.bounds[2] + np.arange(self.steps[1]) * self.resolution, 2)
+      grid_x, grid_y = np.meshgrid(xs, ys, indexing='ij')
+      points = np.vstack([np.column_stack((grid_x.ravel(), grid_y.ravel(), np.full(grid_x.size, z)))
+                          for z in self.heights])
+
+      reachable = np.asarray(reachable_points(points), dtype=bool)
+      self.mask = reachable.reshape((len(self.heights),) + self.steps).all(axis=0)
+
+  def cell(self, xy):
+      i = int(round((xy[0] - self.bounds[0]) / self.resolution))
+      j = int(round((xy[1] - self.bounds[2]) / self.resolution))
+      return i, j
+
+  def reachable(self, xy):
+      i, j = self.cell(xy)
+      if 0 <= i < self.steps[0] and 0 <= j < self.steps[1]:
+          return bool(self.mask[i, j])
+      return False
+
+  def lookup(self, centres):
+      # reachable() for every row of an (N, 2) array
+      i = np.rint((centres[:, 0] - self.bounds[0]) / self.resolution).astype(int)
+      j = np.rint((centres[:, 1] - self.bounds[2]) / self.resolution).astype(int)
+      inside = (i >= 0) & (i < self.steps[0]) & (j >= 0) & (j < self.steps[1])
+      found = np.zeros(len(centres), dtype=bool)
+      found[inside] = self.mask[i[inside], j[inside]]
+
+      return found
+
+  def save(self, path):
+      # written aside and renamed, so a reader never sees half a file
+      partial = path + '.partial'
+      with open(partial, 'wb') as f:
+          np.savez(f, bounds=self.bounds, heights=self.heights,
+                   resolution=self.resolution, mask=self.mask)
+      os.rename(partial, path)
+
+  def load(self, path):
+      ## True if `path` held a map of the same grid and heights.
+      try:
+          data = np.load(path)
+          same = (len(data['heights']) == len(self.heights) and
+                  np.allclose(data['heights'], self.heights) and
+                  np.allclose(data['bounds'], self.bounds) and
+                  np.isclose(data['resolution'], self.resolution) and
+                  data['mask'].shape == self.steps)
+      except (IOError, KeyError, ValueError):
+          return False
+
+      if same:
+          self.mask = data['mask']
+      return same
+
+
+class PoissonDiskLayout(object):
+  """PoissonDiskLayout"""
+  ## Seedable start layouts for any number of objects (Bridson's Poisson
+  ## disk sampling). New points are tried in the ring between one and two
+  ## spacings around an active point; a point that fails `attempts` times
+  ## is retired. Every try either places an object or counts towards
+  ## retiring a point, so generation always ends, either with the layout or
+  ## with an error saying the objects do not fit.
+  def __init__(self, bounds, margins, min_spacing=0.1, attempts=30):
+      lower_x, upper_x, lower_y, upper_y = bounds
+      margin_x, margin_y = margins
+      self.x_range = (lower_x + margin_x, upper_x - margin_x)
+      self.y_range = (lower_y + margin_y, upper_y - margin_y)
+      self.min_spacing = min_spacing
+      self.attempts = attempts
+
+  def generate(self, footprints, seed=None):
+      ## footprints is a list of (name, half extents) in placement order.
+      ## Returns name -> (x, y) with centres at least min_spacing apart and
+      ## no overlapping footprints.
+      rng = random.Random(seed)
+      spacing = self.min_spacing
+      # background grid: a cell this size holds at most one centre
+      cell = spacing / sqrt(2)
+      background = {}
+      placed = FootprintGrid()
+      layout = {}
+      active = []
+      pending = list(footprints)
+
+      def place(obj_name, half, x, y):
+          x = float("%.2f" % x)
+          y = float("%.2f" % y)
+          if not (self.x_range[0] <= x <= self.x_range[1] and self.y_range[0] <= y <= self.y_range[1]):
+              return False
+
+          i = int(x // cell)
+          j = int(y // cell)
+          for di in range(-2, 3):
+              for dj in range(-2, 3):
+                  other = background.get((i + di, j + dj))
+                  if other is not None and (other[0] - x) ** 2 + (other[1] - y) ** 2 < spacing ** 2:
+                      return False
+          if placed.query((x, y), half):
+              return False
+
+          background[(i, j)] = (x, y)
+          placed.insert(obj_name, (x, y), half)
+          layout[obj_name] = (x, y)
+          active.append((x, y))
+          return True
+
+      while pending:
+          obj_name, half = pending[0]
+
+          if not active:
+              # start a new disk anywhere on the table
+              for attempt in range(self.attempts):
+                  if place(obj_name, half, rng.uniform(*self.x_range), rng.uniform(*self.y_range)):
+                      pending.pop(0)
+                      break
+              else:
+                  raise RuntimeError("No space on the table for " + obj_name)
+              continue
+
+          k = rng.randrange(len(active))
+          centre_x, centre_y = active[k]
+          for attempt in range(self.attempts):
+              angle = rng.uniform(0, 2 * pi)
+              radius = rng.uniform(spacing, 2 * spacing)
+              if place(obj_name, half, centre_x + radius * cos(angle), centre_y + radius * sin(angle)):
+                  pending.pop(0)
+                  break
+          else:
+              active[k] = active[-1]
+              active.pop()
+
+      return layout
+
+
+class RearrangementPlanner(object):
+  """RearrangementPlanner"""
+  ## Plans the whole sort up front. An object can go straight to its goal
+  ## once no other object sits on that goal; when every remaining object
+  ## is blocked (a dependency cycle such as plate and knife swapping
+  ## places) one object is parked in a buffer spot first. The plan has one
+  ## move per misplaced object plus one per broken cycle. Objects without
+  ## a goal are only moved, to a buffer spot, when they cover one.
+  ## With a MotionCostModel the next ready object is the one that is
+  ## quickest to fetch and put in place from where the arm is, and buffer
+  ## spots are ranked by the time of the detour through them.
+  def __init__(self, bounds, margins=(0.12, 0.05), tolerance=0.005, cost_model=None):
+      # bounds is (lower_x, upper_x, lower_y, upper_y) of the table
+      self.occupancy = OccupancyMap(bounds, margins)
+      self.tolerance = tolerance
+      self.cost_model = cost_model
+
+  def overlaps(self, xy_a, half_a, xy_b, half_b):
+      overlap_x = intersection((xy_a[0] - half_a[0], xy_a[0] + half_a[0]),
+                               (xy_b[0] - half_b[0], xy_b[0] + half_b[0]))
+      overlap_y = intersection((xy_a[1] - half_a[1], xy_a[1] + half_a[1]),
+                               (xy_b[1] - half_b[1], xy_b[1] + half_b[1]))
+
+      return overlap_x > 0 and overlap_y > 0
+
+  def in_place(self, xy, target):
+      return abs(xy[0] - target[0]) <= self.tolerance and abs(xy[1] - target[1]) <= self.tolerance
+
+  def blockers(self, obj_name, position, state, footprints):
+      # objects currently covering `position`
+      found = []
+      for other, other_xy in state.items():
+          if other != obj_name and self.overlaps(position, footprints[obj_name], other_xy, footprints[other]):
+              found.append(other)
+      return found
+
+  def blocking(self, pending, state, targets, footprints):
+      # how many pending goals each object covers
+      counts = Counter()
+      for obj_name in pending:
+          for other in self.blockers(obj_name, targets[obj_name], state, footprints):
+              counts[other] += 1
+      return counts
+
+  def check_targets(self, targets, footprints):
+      names = sorted(targets.keys())
+      for i in range(len(names)):
+          for j in range(i + 1, len(names)):
+              a = names[i]
+              b = names[j]
+              if self.overlaps(targets[a], footprints[a], targets[b], footprints[b]):
+                  raise ValueError("Goals of " + a + " and " + b + " overlap")
+
+  def find_buffer(self, obj_name, state, targets, pending, footprints):
+      obstacles = FootprintGrid()
+      for other, other_xy in state.items():
+          if other != obj_name:
+              obstacles.insert(other, other_xy, footprints[other])
+
+      # prefer spots that are not another object's goal, so parking does
+      # not create a new dependency
+      goals = FootprintGrid()
+      for other, other_xy in state.items():
+          if other != obj_name:
+              goals.insert(other, other_xy, footprints[other])
+      for other in pending:
+          if other != obj_name:
+              goals.insert(('goal', other), targets[other], footprints[other])
+
+      cost = None
+      if self.cost_model is not None and obj_name in targets:
+          cost = lambda centres: self.cost_model.detour_time(state[obj_name], centres, targets[obj_name])
+      elif self.cost_model is not None:
+          # an object without a goal stays where it is parked
+          model = self.cost_model
+          cost = lambda centres: model.leg(model.table_points(state[obj_name]), centres, True)[1]
+
+      for index in [goals, obstacles]:
+          buffer_xy = self.occupancy.nearest_free(footprints[obj_name], index, state[obj_name], cost=cost)
+          if buffer_xy is not None:
+              return buffer_xy
+
+      return None
+
+  def next_ready(self, ready, state, targets, position):
+      # cheapest to fetch and place from `position`, else the first by name
+      if self.cost_model is None or position is None or len(ready) == 1:
+          return ready[0]
+      times = self.cost_model.pick_and_place_time(position, [state[obj_name] for obj_name in ready],
+                                                  [targets[obj_name] for obj_name in ready])
+      return ready[int(np.argmin(np.round(times, 9)))]
+
+  def plan(self, current, targets, footprints, position=None):
+      ## current and targets map object name -> (x, y), footprints map
+      ## name -> (half depth, half width). `position` is where the end
+      ## effector starts, if known. Returns a list of (name, (x, y),
+      ## is_buffer) moves.
+      self.check_targets(targets, footprints)
+
+      state = dict(current)
+      pending = [name for name in sorted(targets.keys()) if not self.in_place(state[name], targets[name])]
+      moves = []
+
+      while pending:
+          ready = [obj_name for obj_name in pending
+                   if not self.blockers(obj_name, targets[obj_name], state, footprints)]
+
+          if ready:
+              chosen = self.next_ready(ready, state, targets, position)
+              state[chosen] = targets[chosen]
+              pending.remove(chosen)
+              moves.append((chosen, targets[chosen], False))
+              if self.cost_model is not None:
+                  position = self.cost_model.placed_at(targets[chosen])
+              continue
+
+          # every remaining goal is covered: park the object that blocks
+          # the most other goals, which may be one without a goal of its own
+          blocking = self.blocking(pending, state, targets, footprints)
+          parked = max(blocking, key=lambda name: (blocking[name], name))
+
+          buffer_xy = self.find_buffer(parked, state, targets, pending, footprints)
+          if buffer_xy is None:
+              raise RuntimeError("No free buffer space for " + parked)
+          covered = sum(blocking.values())
+          state[parked] = buffer_xy
+          # every parking move has to uncover goals, else the plan would
+          # keep parking forever
+          if sum(self.blocking(pending, state, targets, footprints).values()) >= covered:
+              raise RuntimeError("Parking " + parked + " frees no goal")
+          moves.append((parked, buffer_xy, True))
+          if self.cost_model is not None:
+              position = self.cost_model.placed_at(buffer_xy)
+
+      return moves
+
+
+###############################################################################
+##  Corner blending and time parameterization
+##
+##  Works on any (N, D) path of trajectory positions: joint values on the
+##  real arm, end-effector x, y, z on the simulated one. Used to stitch
+##  the legs of a pick-and-place into one trajectory that keeps moving
+##  through its waypoints.
+###############################################################################
+
+# How far before and after a corner the path is rounded off, in the units
+# of the trajectory positions
+BLEND_RADIUS = 0.04
+
+# Speed (units/s) and acceleration (units/s^2) limits for stitched
+# trajectories, the same as the simulated arm's
+STITCH_VELOCITY = 0.25
+STITCH_ACCELERATION = 0.5
+
+# Turns (radians) below this are left alone, above BLEND_MAX_TURN they are
+# reversals that have to stop anyway
+BLEND_MIN_TURN = 0.05
+BLEND_MAX_TURN = 2.5
+
+
+def segment_geometry(path):
+  ## Segment lengths and the turn angle at every interior point.
+  steps = np.diff(path, axis=0)
+  lengths = np.sqrt((steps ** 2).sum(axis=1))
+  directions = steps / np.maximum(lengths, 1e-12)[:, None]
+  cosines = np.clip((directions[:-1] * directions[1:]).sum(axis=1), -1.0, 1.0)
+
+  return lengths, np.arccos(cosines)
+
+
+def blend_corners(path, radius=BLEND_RADIUS, keep=()):
+  ## Replaces the stretch of path within `radius` of each corner by a
+  ## quadratic Bezier curve through it. Points whose index is in `keep`
+  ## are passed through exactly. Returns the new path and the new indices
+  ## of the kept points.
+  path = np.asarray(path, dtype=float)
+  keep = sorted(keep)
+  if len(path) < 3 or radius <= 0:
+      return path, keep
+
+  lengths, turns = segment_geometry(path)
+  s = np.concatenate(([0.0], np.cumsum(lengths)))
+  corners = [k + 1 for k in np.flatnonzero((turns > BLEND_MIN_TURN) & (turns < BLEND_MAX_TURN))
+             if k + 1 not in keep]
+  if not corners:
+      return path, keep
+
+  # a corner's blend must not run into the next corner, a kept point or
+  # the ends of the path
+  anchors = sorted(set(corners) | set(keep) | set([0, len(path) - 1]))
+
+  def point_at(arc):
+      k = min(max(np.searchsorted(s, arc), 1), len(s) - 1)
+      span = s[k] - s[k - 1]
+      t = (arc - s[k - 1]) / span if span > 0 else 0.0
+      return path[k - 1] + (path[k] - path[k - 1]) * t
+
+  pieces = []
+  new_keep = dict((k, None) for k in keep)
+  start = 0
+  for corner in corners:
+      position = anchors.index(corner)
+      before = s[corner] - s[anchors[position - 1]]
+      after = s[anchors[position + 1]] - s[corner]
+      r = min(radius, before / 2, after / 2)
+      if r <= 0:
+          continue
+
+      first = np.searchsorted(s, s[corner] - r, side='left')
+      last = np.searchsorted(s, s[corner] + r, side='right')
+      for k in range(start, first):
+          if k in new_keep:
+              new_keep[k] = sum(len(piece) for piece in pieces) + k - start
+      pieces.append(path[start:first])
+
+      count = max(3, last - first + 1)
+      t = np.linspace(0.0, 1.0, count)[:, None]
+      p0 = point_at(s[corner] - r)
+      p2 = point_at(s[corner] + r)
+      pieces.append((1 - t) ** 2 * p0 + 2 * (1 - t) * t * path[corner] + t ** 2 * p2)
+      start = last
+
+  offset = sum(len(piece) for piece in pieces)
+  for k in range(start, len(path)):
+      if k in new_keep:
+          new_keep[k] = offset + k - start
+  pieces.append(path[start:])
+
+  return np.vstack(pieces), [new_keep[k] for k in keep]
+
+
+def trajectory_positions(plan):
+  points = plan.joint_trajectory.points
+  if isinstance(points, SimPointList):
+      return points.positions
+  return np.array([point.positions for point in points], dtype=float)
+
+
+def trajectory_times(plan):
+  points = plan.joint_trajectory.points
+  if isinstance(points, SimPointList):
+      return points.times
+  return np.array([point.time_from_start.to_sec() for point in points], dtype=float)
+
+
+def time_parameterize(path, velocity, acceleration, stops=()):
+  ## Times for the points of `path` so that the speed along it stays
+  ## under `velocity` and the acceleration (speeding up, slowing down and
+  ## turning) under `acceleration`. The path starts and ends at rest, and
+  ## so does every point in `stops`. Constant acceleration between points.
+  path = np.asarray(path, dtype=float)
+  if len(path) < 2:
+      return np.zeros(len(path))
+
+  # repeated points take no time and do not count as corners
+  moving = np.concatenate(([True], np.sqrt((np.diff(path, axis=0) ** 2).sum(axis=1)) > 1e-9))
+  unique = path[moving]
+  position = np.cumsum(moving) - 1
+  if len(unique) < 2:
+      return np.zeros(len(path))
+
+  lengths, turns = segment_geometry(unique)
+
+  # turning by `turn` over one step at speed v needs 2 v^2 sin(turn / 2) / step
+  step = np.minimum(lengths[:-1], lengths[1:])
+  bend = np.maximum(2 * np.sin(turns / 2), 1e-12)
+  limit = np.empty(len(unique))
+  limit[0] = limit[-1] = 0.0
+  limit[1:-1] = np.minimum(velocity, np.sqrt(acceleration * step / bend))
+  for k in stops:
+      limit[position[k]] = 0.0
+
+  # forward and backward passes keep the speed reachable from both sides.
+  # In squared speeds v[k]^2 = min(limit[k]^2, v[k-1]^2 + 2 a ds) unrolls
+  # to a running minimum of limit[j]^2 - 2 a s[j] plus 2 a s[k], where s
+  # is the distance along the path.
+  s = np.concatenate(([0.0], np.cumsum(lengths)))
+  squared = limit ** 2
+  squared = 2 * acceleration * s + np.minimum.accumulate(squared - 2 * acceleration * s)
+  squared = (2 * acceleration * (s[-1] - s) +
+             np.minimum.accumulate((squared - 2 * acceleration * (s[-1] - s))[::-1])[::-1])
+  v = np.sqrt(np.maximum(squared, 0.0))
+  mean_speed = v[:-1] + v[1:]
+  dt = np.where(mean_speed > 0, 2 * lengths / np.maximum(mean_speed, 1e-12),
+                2 * np.sqrt(lengths / acceleration))
+  times = np.concatenate(([0.0], np.cumsum(dt)))
+
+  return times[position]
+
+
+###############################################################################
+##  Motion cost model
+##
+##  Estimates the path length and execution time of set_waypoints legs
+##  without the planner, for ranking many candidate moves at once. A leg
+##  is a lift, a straight transit at travel height and a lower to the
+##  working height, each timed as a rest-to-rest trapezoidal profile; the
+##  right-angle corners between them nearly stop the arm anyway.
+###############################################################################
+
+def trapezoid_time(distance, velocity, acceleration):
+  ## Time to cover `distance` from rest to rest, speeding up at
+  ## `acceleration` to at most `velocity`. Works on arrays.
+  distance = np.asarray(distance, dtype=float)
+  ramp = velocity * velocity / acceleration
+  return np.where(distance < ramp, 2 * np.sqrt(distance / acceleration), distance / velocity + velocity / acceleration)
+
+
+class MotionCostModel(object):
+  """MotionCostModel"""
+  ## Positions are end-effector (x, y, z) or, for objects and goals,
+  ## (x, y) on the table with the gripper at `working_height`. An empty
+  ## gripper travels `approach_lift` above the working height, a loaded one
+  ## `carry_lift` above where it picked the object up.
+  def __init__(self, working_height, approach_lift, carry_lift,
+               velocity=STITCH_VELOCITY, acceleration=STITCH_ACCELERATION):
+      self.working_height = working_height
+      self.approach_lift = approach_lift
+      self.carry_lift = carry_lift
+      self.velocity = velocity
+      self.acceleration = acceleration
+
+  def placed_at(self, xy):
+      return (xy[0], xy[1], self.working_height)
+
+  def leg(self, start, goal, obj_attached):
+      ## (length, time) of the legs from the (..., 3) end-effector
+      ## positions `start` to the (..., 2) table positions `goal`, with
+      ## numpy broadcasting between the two.
+      start = np.asarray(start, dtype=float)
+      goal = np.asarray(goal, dtype=float)
+      if obj_attached:
+          top = start[..., 2] + self.carry_lift
+      else:
+          top = np.full(start.shape[:-1], self.working_height + self.approach_lift)
+
+      lift = np.abs(top - start[..., 2])
+      transit = np.sqrt(((goal - start[..., :2]) ** 2).sum(axis=-1))
+      lower = top - self.working_height
+
+      v = self.velocity
+      a = self.acceleration
+      length = lift + transit + lower
+      duration = trapezoid_time(lift, v, a) + trapezoid_time(transit, v, a) + trapezoid_time(lower, v, a)
+
+      return length, duration
+
+  def table_points(self, xy):
+      xy = np.asarray(xy, dtype=float)
+      return np.concatenate((xy, np.full(xy.shape[:-1] + (1,), self.working_height)), axis=-1)
+
+  def pick_and_place_time(self, position, picks, places):
+      # approach from `position`, then carry from each pick to its place
+      approach = self.leg(position, picks, False)[1]
+      carry = self.leg(self.table_points(picks), places, True)[1]
+      return approach + carry
+
+  def detour_time(self, xy, spots, goal):
+      # carrying from `xy` to each of the (K, 2) `spots` and later on to `goal`
+      there = self.leg(self.table_points(xy), spots, True)[1]
+      onwards = self.leg(self.table_points(spots), goal, True)[1]
+      return there + onwards
+
+
+###############################################################################
+##  Retiming
+##
+##  Planned legs are retimed before they run: time-optimal along the same
+##  path, under velocity and acceleration limits scaled from the arm's,
+##  with a gentler profile while an object is held. MoveIt's time-optimal
+##  trajectory generation does it on the real arm, time_parameterize on
+##  the simulated one and in the offline check.
+###############################################################################
 
+# (velocity scaling, acceleration scaling) of the arm's limits
+RETIME_PROFILES = {'empty': (0.5, 0.5), 'carrying': (0.3, 0.3)}
+
+
+class Retimer(object):
+  """Retimer"""
+  def __init__(self):
+      self.enabled = False
+      self.profiles = dict(RETIME_PROFILES)
+      self.backend = None
+      self.legs = 0
+      self.saved = 0.0
+
+  def profile(self, obj_attached):
+      return self.profiles['carrying' if obj_attached else 'empty']
+
+  def retime(self, plan, obj_attached):
+      if not self.enabled or self.backend is None:
+          return plan
+
+      velocity_scaling, acceleration_scaling = self.profile(obj_attached)
+      with tracer.span('motion.retime', attached=bool(obj_attached)):
+          retimed = self.backend.retime(plan, velocity_scaling, acceleration_scaling)
+      self.legs += 1
+      self.saved += trajectory_times(plan)[-1] - trajectory_times(retimed)[-1]
+
+      return retimed
+
+  def report(self):
+      return "Retiming: {} legs, {:.2f}s of motion saved".format(self.legs, self.saved)
+
+
+retimer = Retimer()
+
+
+def trajectory_limits(positions, times):
+  ## Peak speed and acceleration along a trajectory timed with constant
+  ## acceleration between points (as time_parameterize does): the point
+  ## speeds follow from the segment lengths and durations.
+  positions = np.asarray(positions, dtype=float)
+  times = np.asarray(times, dtype=float)
+  lengths = np.sqrt((np.diff(positions, axis=0) ** 2).sum(axis=1))
+  dt = np.diff(times)
+  moving = dt > 0
+
+  speeds = [0.0]
+  accelerations = []
+  for length, step in zip(lengths[moving], dt[moving]):
+      speeds.append(max(2 * length / step - speeds[-1], 0.0))
+      accelerations.append(abs(speeds[-1] - speeds[-2]) / step)
+
+  return max(speeds), max(accelerations) if accelerations else 0.0
+
+
+def peak_ratios(positions, times, velocity, acceleration):
+  ## Peak speed and acceleration of a trajectory as fractions of the
+  ## limits: along the path for scalar limits (the simulated arm's), per
+  ## joint from finite differences for per-joint limits.
+  if np.ndim(velocity) == 0:
+      peak_v, peak_a = trajectory_limits(positions, times)
+      return peak_v / velocity, peak_a / acceleration
+
+  positions = np.asarray(positions, dtype=float)
+  times = np.asarray(times, dtype=float)
+  dt = np.diff(times)
+  moving = dt > 0
+  velocities = np.diff(positions, axis=0)[moving] / dt[moving][:, None]
+  if len(velocities) < 2:
+      accelerations = np.zeros((1, positions.shape[1]))
+  else:
+      middles = (times[1:][moving] + times[:-1][moving]) / 2
+      accelerations = np.diff(velocities, axis=0) / np.maximum(np.diff(middles), 1e-9)[:, None]
+
+  return (np.abs(velocities) / velocity).max(), (np.abs(accelerations) / acceleration).max()
+
+
+def synthetic_legs(count=200, seed=0, timing=None):
+  ## set_waypoints-style legs (lift, transit, lower) between random table
+  ## positions, sampled every EEF_STEP and timed like the planner's.
+  if timing is None:
+      timing = SimTiming()
+  rng = random.Random(seed)
+  legs = []
+  for k in range(count):
+      start = (rng.uniform(0.25, 0.55), rng.uniform(-0.35, 0.35), 0.38)
+      goal = (rng.uniform(0.25, 0.55), rng.uniform(-0.35, 0.35))
+      top = 0.38 + (0.2 if k % 2 else 0.05)
+      corners = np.array([start, (start[0], start[1], top), (goal[0], goal[1], top), (goal[0], goal[1], 0.38)])
+      path = straight_path(corners, EEF_STEP)
+      legs.append((path, timing.timed_points(path).times, bool(k % 2)))
+
+  return legs
+
+
+def check_retiming(library_path=None, backend=None):
+  ## Check of the retiming profiles on the legs of a trajectory library
+  ## or on synthetic legs: each leg goes through `backend`'s retime, and
+  ## the result is measured against that backend's scaled limits. Prints
+  ## how much shorter the legs get and returns whether they all stay
+  ## within the limits. By default a library recorded on the real arm is
+  ## retimed by MoveIt, anything else by the simulated backend.
+  joint_names = SIM_JOINT_NAMES
+  if library_path is not None:
+      library = TrajectoryLibrary()
+      library.open(library_path)
+      if None in library.attached.values():
+          print("ERROR - " + library_path + " does not say which legs carry an object, "
+                "rebuild it with --build-library")
+          return False
+      joint_names = library.joint_names
+      legs = []
+      for key, (start, count) in sorted(library.entries.items(), key=lambda item: item[1]):
+          block = np.asarray(library.points[start:start + count], dtype=float)
+          legs.append((block[:, :-1], block[:, -1], library.attached[key]))
+      source = library_path
+  if backend is None:
+      backend = SimulatedBackend() if joint_names == SIM_JOINT_NAMES else MoveItBackend()
+  if library_path is None:
+      legs = synthetic_legs(timing=backend.timing)
+      source = "synthetic legs"
+
+  print("{} legs from {}".format(len(legs), source))
+  print("{:<10} {:>5} {:>10} {:>10} {:>8} {:>12} {:>12}".format(
+      "profile", "legs", "before", "after", "change", "peak v/lim", "peak a/lim"))
+  within = True
+  for name in ['empty', 'carrying']:
+      velocity_scaling, acceleration_scaling = retimer.profiles[name]
+      velocity, acceleration = backend.retime_limits(joint_names, velocity_scaling, acceleration_scaling)
+
+      before = after = 0.0
+      peak_v = peak_a = 0.0
+      selected = [(path, times) for path, times, carrying in legs if carrying == (name == 'carrying')]
+      for path, times in selected:
+          plan = backend.retime(backend.trajectory_from(joint_names, path, times),
+                                velocity_scaling, acceleration_scaling)
+          retimed = trajectory_times(plan)
+          leg_v, leg_a = peak_ratios(trajectory_positions(plan), retimed, velocity, acceleration)
+          before += times[-1]
+          after += retimed[-1]
+          peak_v = max(peak_v, leg_v)
+          peak_a = max(peak_a, leg_a)
+
+      if not selected:
+          continue
+      within = within and peak_v <= 1.0 + 1e-6 and peak_a <= 1.0 + 1e-6
+      print("{:<10} {:>5} {:>9.2f}s {:>9.2f}s {:>7.1f}% {:>12.3f} {:>12.3f}".format(
+          name, len(selected), before, after, 100.0 * (after - before) / before, peak_v, peak_a))
+
+  print("Within limits" if within else "LIMITS EXCEEDED")
+  return within
+
+
+###############################################################################
+##  Simulated MoveIt backend
+##
+##  In-process stand-ins for RobotCommander, PlanningSceneInterface and
+##  MoveGroupCommander, so the whole pipeline runs without ROS. The "joints"
+##  of the simulated arm are the end-effector x, y, z, and motions are
+##  timed by a simple kinematic model.
+###############################################################################
+
+SIM_JOINT_NAMES = ['eef_x', 'eef_y', 'eef_z']
+
+# End-effector position of the Panda's 'ready' pose
+SIM_HOME = (0.307, 0.0, 0.59)
+
+# Reach of the Panda measured from its shoulder joint
+SIM_SHOULDER = (0.0, 0.0, 0.333)
+SIM_REACH = 0.855
+
+
+class SimPoint(object):
+  """SimPoint"""
+  def __init__(self, x=0.0, y=0.0, z=0.0):
+      self.x = x
+      self.y = y
+      self.z = z
+
+
+class SimQuaternion(object):
+  """SimQuaternion"""
+  def __init__(self, x=0.0, y=0.0, z=0.0, w=1.0):
+      self.x = x
+      self.y = y
+      self.z = z
+      self.w = w
+
+
+class SimPose(object):
+  """SimPose"""
+  def __init__(self, xyz=(0.0, 0.0, 0.0)):
+      self.position = SimPoint(xyz[0], xyz[1], xyz[2])
+      # gripper pointing down at the table
+      self.orientation = SimQuaternion(1.0, 0.0, 0.0, 0.0)
+
+  def __deepcopy__(self, memo):
+      # set_waypoints copies poses a lot; skip the generic deepcopy machinery
+      p = self.position
+      o = self.orientation
+      pose = SimPose((p.x, p.y, p.z))
+      pose.orientation = SimQuaternion(o.x, o.y, o.z, o.w)
+      return pose
+
+
+class SimPoseStamped(object):
+  """SimPoseStamped"""
+  def __init__(self, xyz=(0.0, 0.0, 0.0), frame_id="panda_link0"):
+      self.frame_id = frame_id
+      self.pose = SimPose(xyz)
+
+
+class SimDuration(object):
+  """SimDuration"""
+  def __init__(self, secs):
+      self.secs = secs
+
+  def to_sec(self):
+      return self.secs
+
+
+class SimTrajectoryPoint(object):
+  """SimTrajectoryPoint"""
+  def __init__(self, positions, time_from_start):
+      self.positions = list(positions)
+      self.velocities = []
+      self.accelerations = []
+      self.time_from_start = SimDuration(time_from_start)
+
+
+class SimPointList(object):
+  """SimPointList"""
+  ## Trajectory points kept as (N, 3) positions and (N,) times; point
+  ## objects are only made when one is looked at.
+  def __init__(self, positions, times):
+      self.positions = positions
+      self.times = times
+
+  def __len__(self):
+      return len(self.times)
+
+  def __getitem__(self, k):
+      if isinstance(k, slice):
+          return [self[n] for n in range(*k.indices(len(self)))]
+      return SimTrajectoryPoint(self.positions[k].tolist(), float(self.times[k]))
+
+  def __iter__(self):
+      for k in range(len(self)):
+          yield self[k]
+
+
+class SimJointTrajectory(object):
+  """SimJointTrajectory"""
+  def __init__(self, joint_names, points):
+      self.joint_names = list(joint_names)
+      self.points = points
+
+
+class SimTrajectory(object):
+  """SimTrajectory"""
+  def __init__(self, points):
+      self.joint_trajectory = SimJointTrajectory(SIM_JOINT_NAMES, points)
+
+
+class SimStats(object):
+  """SimStats"""
+  def __init__(self):
+      self.reset()
+
+  def reset(self):
+      self.planning_calls = 0
+      self.executions = 0
+      self.path_length = 0.0
+      self.motion_time = 0.0
+      # planning calls that fell short of the goal and objects picked up
+      self.partial_plans = 0
+      self.picks = 0
+      self.pose_queries = 0
+
+
+class SimTiming(object):
+  """SimTiming"""
+  ## Kinematic timing model: along a path the end effector speeds up at
+  ## `acceleration` m/s^2 to at most `velocity` m/s, slows down for
+  ## corners and stops at the end. Each planning call costs
+  ## `planning_time` seconds. Plans are timed at a quarter of the arm's
+  ## limits, `max_velocity` and `max_acceleration`, which retiming scales.
+  def __init__(self, velocity=0.25, acceleration=0.5, planning_time=0.0,
+               max_velocity=1.0, max_acceleration=2.0):
+      self.velocity = velocity
+      self.acceleration = acceleration
+      self.planning_time = planning_time
+      self.max_velocity = max_velocity
+      self.max_acceleration = max_acceleration
+
+  def timed_points(self, path, stops=()):
+      path = np.asarray(path, dtype=float)
+      times = time_parameterize(path, self.velocity, self.acceleration, stops)
+
+      return SimPointList(path, times)
+
+
+def distance(a, b):
+  return sqrt(sum((a[k] - b[k]) ** 2 for k in range(len(a))))
+
+
+class SimRobotState(object):
+  """SimRobotState"""
+  def __init__(self, eef=SIM_HOME):
+      self.eef = list(eef)
+
+
+class SimStartState(object):
+  """SimStartState"""
+  ## Planning start state other than the current one: end-effector
+  ## position, the objects held there (name -> (link, dims, offset)) and
+  ## objects put down since (name -> (xyz, dims)).
+  def __init__(self, eef, attached, placed=None):
+      self.eef = list(eef)
+      self.attached = attached
+      if placed is None:
+          placed = {}
+      self.placed = placed
+
+
+class SimRobot(object):
+  """SimRobot"""
+  def get_group_names(self):
+      return ['panda_arm', 'hand', 'panda_arm_hand']
+
+  def get_link_names(self, group=None):
+      if group == 'hand':
+          return ['panda_hand', 'panda_leftfinger', 'panda_rightfinger']
+      return ['panda_link%d' % k for k in range(9)]
+
+  def get_current_state(self):
+      return None
+
+
+class SimScene(object):
+  """SimScene"""
+  def __init__(self, state):
+      self.state = state
+      # name -> [xyz, dims] for world objects
+      self.world = {}
+      # name -> (link, dims, offset from the end effector)
+      self.attached = {}
+
+  def add_box(self, name, pose, size=(1, 1, 1)):
+      p = pose.pose.position
+      self.world[name] = [(p.x, p.y, p.z), tuple(size)]
+
+  def remove_world_object(self, name=None):
+      if name is None:
+          self.world.clear()
+      else:
+          self.world.pop(name, None)
+
+  def attach_box(self, link, name, pose=None, size=None, touch_links=[]):
+      xyz, dims = self.world.pop(name)
+      eef = self.state.eef
+      offset = tuple(xyz[k] - eef[k] for k in range(3))
+      self.attached[name] = (link, dims, offset)
+
+  def remove_attached_object(self, link=None, name=None):
+      link, dims, offset = self.attached.pop(name)
+      eef = self.state.eef
+      self.world[name] = [tuple(eef[k] + offset[k] for k in range(3)), dims]
+
+  def get_known_object_names(self, with_type=False):
+      return list(self.world.keys())
+
+  def get_attached_objects(self, object_ids=[]):
+      if not object_ids:
+          object_ids = self.attached.keys()
+      return dict((name, self.attached[name]) for name in object_ids if name in self.attached)
+
+  def collisions(self, points, attached=None, placed=None):
+      ## Which of the (N, 3) end-effector positions put the gripper tip or
+      ## a held object inside a world box. Boxes that only touch (within a
+      ## small tolerance) do not collide. `attached` and `placed` override
+      ## the held objects and add boxes to the world, for planning from a
+      ## predicted state.
+      if attached is None:
+          attached = self.attached
+      world = self.world.items()
+      if placed:
+          world = world + placed.items()
+
+      boxes = [(xyz, dims) for name, (xyz, dims) in world if name not in attached]
+      held = [(offset, held_dims) for link, held_dims, offset in attached.values()]
+
+      return box_collisions(points, boxes, held)
+
+
+class SimMoveGroup(object):
+  """SimMoveGroup"""
+  def __init__(self, state, scene, timing, stats, time_scale=0.0):
+      self.state = state
+      self.scene = scene
+      self.timing = timing
+      self.stats = stats
+      # 0 runs as fast as possible, 1 sleeps through motions in real time
+      self.time_scale = time_scale
+      self.pose_target = None
+      self.start_state = None
+
+  def get_planning_frame(self):
+      return "panda_link0"
+
+  def get_end_effector_link(self):
+      return "panda_link8"
+
+  def get_current_pose(self, end_effector_link=""):
+      self.stats.pose_queries += 1
+      return SimPoseStamped(self.state.eef)
+
+  def get_current_joint_values(self):
+      return list(self.state.eef)
+
+  def reachable(self, points):
+      radial = np.sqrt(points[:, 0] ** 2 + points[:, 1] ** 2)
+      reach = np.sqrt(((points - np.asarray(SIM_SHOULDER)) ** 2).sum(axis=1))
+
+      return (points[:, 2] > 0.0) & (radial > 0.15) & (reach <= SIM_REACH)
+
+  def interpolate(self, targets, eef_step, avoid_collisions):
+      ## Straight lines through `targets` from the current position, cut
+      ## short at the first unreachable or colliding point. Returns the
+      ## (N, 3) path and the fraction of the requested length it covers.
+      self.stats.planning_calls += 1
+      if self.timing.planning_time > 0:
+          time.sleep(self.timing.planning_time * self.time_scale)
+
+      start = self.start_state if self.start_state is not None else self.state
+      corners = np.array([start.eef] + list(targets), dtype=float)
+      lengths = np.sqrt((np.diff(corners, axis=0) ** 2).sum(axis=1))
+      path = straight_path(corners, eef_step)
+
+      valid = self.reachable(path[1:])
+      if avoid_collisions:
+          if self.start_state is not None:
+              valid &= ~self.scene.collisions(path[1:], self.start_state.attached, self.start_state.placed)
+          else:
+              valid &= ~self.scene.collisions(path[1:])
+      blocked = np.flatnonzero(~valid)
+
+      fraction = 1.0
+      if len(blocked) > 0 and lengths.sum() > 0:
+          path = path[:blocked[0] + 1]
+          achieved = np.sqrt((np.diff(path, axis=0) ** 2).sum(axis=1)).sum()
+          fraction = float(achieved / lengths.sum())
+      if fraction < 1.0:
+          self.stats.partial_plans += 1
+
+      return path, fraction
+
+  def compute_cartesian_path(self, waypoints, eef_step, jump_threshold, avoid_collisions=True):
+      targets = [(wp.position.x, wp.position.y, wp.position.z) for wp in waypoints]
+      path, fraction = self.interpolate(targets, eef_step, avoid_collisions)
+
+      return (SimTrajectory(self.timing.timed_points(path)), fraction)
+
+  def set_pose_target(self, pose, end_effector_link=""):
+      if hasattr(pose, 'pose'):
+          pose = pose.pose
+      self.pose_target = (pose.position.x, pose.position.y, pose.position.z)
+
+  def clear_pose_targets(self):
+      self.pose_target = None
+
+  def set_start_state(self, state):
+      self.start_state = state
+
+  def set_start_state_to_current_state(self):
+      self.start_state = None
+
+  def plan(self):
+      # joint-space planning is modelled as a lifted detour to the target
+      start = self.start_state if self.start_state is not None else self.state
+      eef = start.eef
+      target = self.pose_target
+      top = max(eef[2], target[2]) + 0.1
+      path, fraction = self.interpolate([(eef[0], eef[1], top), (target[0], target[1], top), target], 0.01, True)
+      traj = SimTrajectory(self.timing.timed_points(path))
+      success = fraction == 1.0
+
+      return (success, traj, self.timing.planning_time, None)
+
+  def execute(self, plan, wait=True):
+      points = plan.joint_trajectory.points
+      if not points:
+          return False
+
+      # like MoveIt, refuse trajectories that do not start where the arm is
+      if distance(points[0].positions, self.state.eef) > 0.01:
+          return False
+
+      self.run(points, [])
+      return True
+
+  def run(self, points, events):
+      ## Moves along the trajectory; `events` are (point index, callback)
+      ## pairs called when the arm passes that point, in order.
+      if isinstance(points, SimPointList):
+          path = points.positions
+          times = points.times
+      else:
+          path = np.array([point.positions for point in points], dtype=float)
+          times = np.array([point.time_from_start.to_sec() for point in points])
+      self.stats.path_length += float(np.sqrt((np.diff(path, axis=0) ** 2).sum(axis=1)).sum())
+      duration = float(times[-1])
+      self.stats.executions += 1
+      self.stats.motion_time += duration
+
+      elapsed = 0.0
+      for index, callback in events:
+          if self.time_scale > 0:
+              time.sleep((times[index] - elapsed) * self.time_scale)
+          elapsed = times[index]
+          self.state.eef = list(path[index])
+          callback()
+      if self.time_scale > 0:
+          time.sleep((duration - elapsed) * self.time_scale)
+
+      self.state.eef = list(path[-1])
+
+  def stop(self):
+      return
+
+
+class SimulatedBackend(object):
+  """SimulatedBackend"""
+  def __init__(self, timing=None, time_scale=0.0, connect_time=0.0):
+      if timing is None:
+          timing = SimTiming()
+      self.timing = timing
+      self.time_scale = time_scale
+      # stands in for importing ROS and constructing the commanders
+      self.connect_time = connect_time
+      self.stats = SimStats()
+
+  def connect(self):
+      if self.connect_time > 0:
+          time.sleep(self.connect_time)
+      state = SimRobotState()
+      scene = SimScene(state)
+      move_group = SimMoveGroup(state, scene, self.timing, self.stats, self.time_scale)
+      self.scene = scene
+      self.move_group = move_group
+
+      return SimRobot(), scene, move_group, None
+
+  def apply_scene_batch(self, arm, batch):
+      scene = self.scene
+      for obj_name in batch.removals:
+          scene.remove_world_object(obj_name)
+      for obj_name, obj_xyz, obj_dims in batch.boxes:
+          scene.add_box(obj_name, SimPoseStamped(obj_xyz), size=obj_dims)
+      for obj_name, obj_xyz in batch.detaches:
+          scene.remove_attached_object(arm.eef_link, name=obj_name)
+      for obj_name in batch.attaches:
+          scene.attach_box(arm.eef_link, obj_name)
+          self.stats.picks += 1
+
+      return True
+
+  def predicted_start_state(self, arm, plan, attach=None, detach=None):
+      # the arm at the end of `plan`, after picking up `attach` or putting
+      # down `detach` there
+      eef = plan.joint_trajectory.points[-1].positions
+      attached = dict(self.scene.attached)
+      placed = {}
+      if attach is not None:
+          obj_xyz, obj_dims = arm.world[attach]
+          offset = tuple(obj_xyz[k] - eef[k] for k in range(3))
+          attached[attach] = (arm.eef_link, tuple(obj_dims), offset)
+      if detach is not None:
+          link, obj_dims, offset = attached.pop(detach)
+          placed[detach] = (tuple(eef[k] + offset[k] for k in range(3)), obj_dims)
+
+      return SimStartState(eef, attached, placed)
+
+  def reachable_points(self, arm, points):
+      return self.move_group.reachable(np.asarray(points, dtype=float))
+
+  def reachability_path(self):
+      # computed in no time, never saved
+      return None
+
+  def make_trajectory(self, plan, positions, times):
+      return SimTrajectory(SimPointList(np.asarray(positions, dtype=float), np.asarray(times, dtype=float)))
+
+  def trajectory_from(self, joint_names, positions, times):
+      return self.make_trajectory(None, positions, times)
+
+  def retime(self, plan, velocity_scaling, acceleration_scaling):
+      positions = trajectory_positions(plan)
+      velocity, acceleration = self.retime_limits(SIM_JOINT_NAMES, velocity_scaling, acceleration_scaling)
+      times = time_parameterize(positions, velocity, acceleration)
+      return self.make_trajectory(plan, positions, times)
+
+  def retime_limits(self, joint_names, velocity_scaling, acceleration_scaling):
+      # speed and acceleration along the end-effector path
+      return (self.timing.max_velocity * velocity_scaling,
+              self.timing.max_acceleration * acceleration_scaling)
+
+  def execute_with_events(self, arm, plan, events):
+      move_group = self.move_group
+      points = plan.joint_trajectory.points
+      if distance(points[0].positions, move_group.state.eef) > 0.01:
+          return False
+      move_group.run(points, events)
+
+      return True
+
+
+class MoveItBackend(object):
+  """MoveItBackend"""
+  ## Talks to a running ROS / MoveIt stack, the arm under `namespace` when
+  ## several share one ROS master.
+  def __init__(self, namespace=''):
+      namespace = namespace.strip('/')
+      self.namespace = '/' + namespace if namespace else ''
+      self.connection = None
+
+  def connect(self):
+      # a process is one ROS node, arms made later reuse its connection
+      if self.connection is None:
+          self.connection = self.open_connection()
+      return self.connection
+
+  def open_connection(self):
+      try:
+          load_ros()
+      except ImportError as e:
+          raise RuntimeError("ROS / MoveIt are not installed, only the simulated backend can be used (" + str(e) + ")")
+
+      ## BEGIN setup
+      ##
+      ## First initialize `moveit_commander`_ and a `rospy`_ node:
+      moveit_commander.roscpp_initialize(sys.argv)
+      # signal handlers can only be installed from the main thread, the
+      # arm may be connecting in the background
+      in_main_thread = threading.current_thread().name == 'MainThread'
+      rospy.init_node('PANDA_TABLE', anonymous=True, disable_signals=not in_main_thread)
+
+      ## Instantiate a `RobotCommander`_ object. Provides information such as the robot's
+      ## kinematic model and the robot's current joint states
+      ns = self.namespace
+      robot_description = ns + '/robot_description' if ns else 'robot_description'
+      robot = moveit_commander.RobotCommander(robot_description=robot_description, ns=ns)
+
+      ## Instantiate a `PlanningSceneInterface`_ object.  This provides a remote interface
+      ## for getting, setting, and updating the robot's internal understanding of the
+      ## surrounding world:
+      scene = moveit_commander.PlanningSceneInterface(ns=ns)
+
+      ## Instantiate a `MoveGroupCommander`_ object.  This object is an interface
+      ## to a planning group (group of joints).  In this program the group is the primary
+      ## arm joints in the Panda robot, so we set the group's name to "panda_arm".
+      ## This interface can be used to plan and execute motions:
+      group_name = "panda_arm"
+      move_group = moveit_commander.MoveGroupCommander(group_name, robot_description=robot_description, ns=ns)
+
+      ## Create a `DisplayTrajectory`_ ROS publisher which is used to display
+      ## trajectories in Rviz:
+      display_trajectory_publisher = rospy.Publisher(ns + '/move_group/display_planned_path',
+                                                     moveit_msgs.msg.DisplayTrajectory,
+                                                     queue_size=20)
+
+      return robot, scene, move_group, display_trajectory_publisher
+
+  def apply_scene_batch(self, arm, batch):
+      # the diff is applied through a service call, so the scene is up to
+      # date once it returns and needs no polling
+      return arm.scene.apply_planning_scene(arm.build_scene_diff(batch))
+
+  def predicted_start_state(self, arm, plan, attach=None, detach=None):
+      ## RobotState at the end of `plan`, after picking up `attach` or
+      ## putting down `detach` there, for planning the next leg before
+      ## that has happened.
+      CollisionObject = moveit_msgs.msg.CollisionObject
+      last = plan.joint_trajectory.points[-1]
+
+      state = moveit_msgs.msg.RobotState()
+      state.is_diff = True
+      state.joint_state.name = list(plan.joint_trajectory.joint_names)
+      state.joint_state.position = list(last.positions)
+
+      if attach is not None:
+          obj_xyz, obj_dims = arm.world[attach]
+          box = shape_msgs.msg.SolidPrimitive()
+          box.type = shape_msgs.msg.SolidPrimitive.BOX
+          box.dimensions = list(obj_dims)
+
+          attached = moveit_msgs.msg.AttachedCollisionObject()
+          attached.link_name = arm.eef_link
+          attached.object.id = attach
+          attached.object.header.frame_id = "panda_link0"
+          attached.object.primitives = [box]
+          attached.object.primitive_poses = [arm.make_pose(obj_xyz).pose]
+          attached.object.operation = CollisionObject.ADD
+          attached.touch_links = arm.robot.get_link_names(group='hand')
+          state.attached_collision_objects.append(attached)
+
+      if detach is not None:
+          # left in the world where the gripper lets go of it
+          attached = moveit_msgs.msg.AttachedCollisionObject()
+          attached.link_name = arm.eef_link
+          attached.object.id = detach
+          attached.object.operation = CollisionObject.REMOVE
+          state.attached_collision_objects.append(attached)
+
+      return state
+
+  def reachable_points(self, arm, points, workers=8):
+      ## Whether each position has an IK solution with the gripper pointing
+      ## down, from move_group's compute_ik service, `workers` at a time.
+      service_name = self.namespace + '/compute_ik'
+      rospy.wait_for_service(service_name, timeout=10.0)
+      compute_ik = rospy.ServiceProxy(service_name, moveit_msgs.srv.GetPositionIK)
+      orientation = arm.move_group.get_current_pose().pose.orientation
+      success = moveit_msgs.msg.MoveItErrorCodes.SUCCESS
+
+      def solvable(point):
+          request = moveit_msgs.msg.PositionIKRequest()
+          request.group_name = arm.move_group.get_name()
+          request.avoid_collisions = False
+          request.timeout = rospy.Duration(0.05)
+          request.pose_stamped.header.frame_id = arm.planning_frame
+          request.pose_stamped.pose.position.x = point[0]
+          request.pose_stamped.pose.position.y = point[1]
+          request.pose_stamped.pose.position.z = point[2]
+          request.pose_stamped.pose.orientation = orientation
+          return compute_ik(request).error_code.val == success
+
+      pool = ThreadPool(workers)
+      try:
+          return pool.map(solvable, [tuple(point) for point in points])
+      finally:
+          pool.close()
+
+  def reachability_path(self):
+      name = 'moveit' + self.namespace.replace('/', '_')
+      return REACHABILITY_PATH.format(name)
+
+  def make_trajectory(self, plan, positions, times):
+      ## Copy of `plan` following the given joint positions and times, with
+      ## velocities and accelerations by finite differences.
+      positions = np.asarray(positions, dtype=float)
+      times = np.asarray(times, dtype=float)
+      velocities = np.gradient(positions, axis=0) / np.maximum(np.gradient(times), 1e-9)[:, None]
+      velocities[0] = velocities[-1] = 0.0
+      accelerations = np.gradient(velocities, axis=0) / np.maximum(np.gradient(times), 1e-9)[:, None]
+
+      trajectory = copy.deepcopy(plan)
+      points = []
+      for k in range(len(times)):
+          point = trajectory_msgs.msg.JointTrajectoryPoint()
+          point.positions = positions[k].tolist()
+          point.velocities = velocities[k].tolist()
+          point.accelerations = accelerations[k].tolist()
+          point.time_from_start = rospy.Duration.from_sec(float(times[k]))
+          points.append(point)
+      trajectory.joint_trajectory.points = points
+
+      return trajectory
+
+  def retime(self, plan, velocity_scaling, acceleration_scaling):
+      # time-optimal along the same path, within the scaled joint limits of
+      # the robot model
+      robot, scene, move_group, display_trajectory_publisher = self.connect()
+      return move_group.retime_trajectory(robot.get_current_state(), plan,
+                                          velocity_scaling, acceleration_scaling,
+                                          algorithm="time_optimal_trajectory_generation")
+
+  def retime_limits(self, joint_names, velocity_scaling, acceleration_scaling):
+      # the per-joint limits time-optimal trajectory generation scales, from
+      # the robot's joint_limits.yaml
+      self.connect()
+      limits = rospy.get_param(self.namespace + '/robot_description_planning/joint_limits')
+      velocity = np.array([limits[name]['max_velocity'] for name in joint_names], dtype=float)
+      acceleration = np.array([limits[name]['max_acceleration'] for name in joint_names], dtype=float)
+
+      return velocity * velocity_scaling, acceleration * acceleration_scaling
+
+  def trajectory_from(self, joint_names, positions, times):
+      plan = moveit_msgs.msg.RobotTrajectory()
+      plan.joint_trajectory.joint_names = list(joint_names)
+
+      return self.make_trajectory(plan, positions, times)
+
+  def execute_with_events(self, arm, plan, events):
+      ## Starts the trajectory and calls each (point index, callback) at
+      ## that point's time while the arm keeps moving.
+      points = plan.joint_trajectory.points
+      if not arm.move_group.execute(plan, wait=False):
+          return False
+
+      start = time.time()
+      for index, callback in events:
+          delay = start + points[index].time_from_start.to_sec() - time.time()
+          if delay > 0:
+              time.sleep(delay)
+          callback()
+
+      return True
+
+
+class HouseholdPandaArm(object):
+  """HouseholdPandaArm"""
+  def __init__(self, backend=None, lazy=False):
+    super(HouseholdPandaArm, self).__init__()
+
+    if backend is None:
+        backend = MoveItBackend()
+    self.backend = backend
 
     # Misc variables
 
@@ -103,40 +2354,86 @@ class HouseholdPandaArm(object):
     #Knife, fork and plate objects will be same height, so have same z coordinates
     self.obj_z_coordinate = ((self.table_size_z) + ((self.obj_height)*0.5))
 
-    # Plate coordinates
+    # Tableware positions, sizes and state
     self.plate_name = "plate"
-    self.plate_x = 0.4
-    self.plate_y = 0
-    self.plate_z = self.obj_z_coordinate
-
-    #Plate dimensions
-    self.plate_size_x = 0.12
-    self.plate_size_y = self.obj_width
-    self.plate_size_z = self.obj_height
+    self.knife_name = "knife"
+    self.fork_name = "fork"
 
+    self.objects = ObjectRegistry()
+    for obj_name, obj_xy, obj_depth in TABLEWARE:
+        self.objects.add(obj_name, (obj_xy[0], obj_xy[1], self.obj_z_coordinate),
+                         (obj_depth, self.obj_width, self.obj_height))
+
+
+    # Spatial index over the object footprints, updated whenever an
+    # object's coordinates change
+    self.footprint_index = FootprintGrid()
+    footprints = self.object_footprints()
+    for obj_name, xy in self.object_positions().items():
+        self.footprint_index.insert(obj_name, xy, footprints[obj_name])
+
+    # Estimated leg times, for choosing moves and spots without planning
+    self.motion_cost = MotionCostModel(self.z_coordinate_above_obj, 0.05, self.obj_height + 0.05)
+
+    table_bounds = (self.table_lower_x, self.table_upper_x, self.table_lower_y, self.table_upper_y)
+    self.rearrangement_planner = RearrangementPlanner(table_bounds, cost_model=self.motion_cost)
+
+    # Candidate spots for parking an object
+    self.buffer_map = OccupancyMap(table_bounds, (0.12, 0.05))
+
+    # Initial layouts keep 0.1 / 0.05 away from the edges like getRandomFloat
+    self.layout_generator = PoissonDiskLayout(table_bounds, (0.1, 0.05))
+
+    # Local mirror of the planning scene: name -> (xyz, dims) for world
+    # objects, plus the object held by the gripper
+    self.world = {}
+    self.attached_obj = None
+
+    # The next object's approach planned ahead in the pipelined motion
+    # mode: (object, predicted start pose, object put down, where,
+    # pending plan)
+    self.prefetched = None
+
+    # Connecting to the robot takes seconds. A lazy arm connects on a
+    # background thread; robot, scene, move_group and the rest appear
+    # when it is done, and anything that needs them waits for it. Motions
+    # also wait for the scene changes queued by when_connected.
+    self.connection = None
+    self.connection_error = None
+    self.connected = False
+    self.deferred = []
+    self.deferred_lock = threading.Lock()
+    if lazy:
+        self.connection = threading.Thread(target=self.connect_in_background)
+        self.connection.daemon = True
+        self.connection.start()
+    else:
+        self.connect()
+        self.connected = True
 
-    # Knife coordinates
-    self.knife_name = "knife"
-    self.knife_x = self.plate_x
-    self.knife_y = self.plate_y - 0.2
-    self.knife_z = self.obj_z_coordinate
+  def connect(self):
+    robot, scene, move_group, display_trajectory_publisher = self.backend.connect()
 
-    # Knife dimensions
-    self.knife_size_x = 0.08
-    self.knife_size_y = self.obj_width
-    self.knife_size_z = self.obj_height
+    ##
+    ## Getting Basic Information
+    ## ^^^^^^^^^^^^^^^^^^^^^^^^^
+    # We can get the name of the reference frame for this robot:
+    planning_frame = move_group.get_planning_frame()
+    #print "============ Planning frame: %s" % planning_frame
 
+    # We can also print the name of the end-effector link for this group:
+    eef_link = move_group.get_end_effector_link()
+    #print "============ End effector link: %s" % eef_link
 
-    # Fork coordinates
-    self.fork_name = "fork"
-    self.fork_x = self.plate_x
-    self.fork_y = self.plate_y + 0.2
-    self.fork_z = self.obj_z_coordinate
+    # We can get a list of all the groups in the robot:
+    group_names = robot.get_group_names()
+    #print "============ Available Planning Groups:", robot.get_group_names()
 
-    # Fork dimensions
-    self.fork_size_x = 0.04
-    self.fork_size_y = self.obj_width
-    self.fork_size_z = self.obj_height
+    # Sometimes for debugging it is useful to print the entire state of the
+    # robot:
+    #print "============ Printing robot state"
+    #print robot.get_current_state()
+    print ""
 
 
     self.robot = robot
@@ -147,19 +2444,119 @@ class HouseholdPandaArm(object):
     self.eef_link = eef_link
     self.group_names = group_names
 
-  global perform_move
-  def perform_move(move_group, waypoints, obj_attached):
+    # End-effector pose as of the last executed leg
+    self.pose_tracker = PoseTracker(move_group)
+
+    # Background planning for the pipelined motion mode
+    self.planning_pipeline = PlanningPipeline(move_group)
+
+    # Stored legs are replayed, and legs retimed, through this arm's backend
+    trajectory_library.backend = self.backend
+    retimer.backend = self.backend
+
+    # Where the gripper can work, so goals and buffer spots out of reach
+    # never get to the planner
+    self.load_reachability()
+
+  def load_reachability(self):
+      ## The reachability map of this robot at the heights the gripper works
+      ## at (grasp, approach and carrying): from memory, from disk, or
+      ## computed by the backend and saved.
+      bounds = (self.table_lower_x, self.table_upper_x, self.table_lower_y, self.table_upper_y)
+      heights = (self.z_coordinate_above_obj, self.z_coordinate_above_obj + 0.05,
+                 self.z_coordinate_above_obj + self.obj_height + 0.05)
+      path = self.backend.reachability_path()
+      key = (type(self.backend).__name__, path, bounds, heights)
+
+      reachability = reachability_maps.get(key)
+      if reachability is None:
+          reachability = ReachabilityMap(bounds, heights)
+          if path is None or not reachability.load(path):
+              with tracer.span('reachability.compute'):
+                  reachability.compute(lambda points: self.backend.reachable_points(self, points))
+              if path is not None:
+                  reachability.save(path)
+          reachability_maps[key] = reachability
+
+      self.reachability = reachability
+      for occupancy in [self.buffer_map, self.rearrangement_planner.occupancy]:
+          occupancy.restrict(reachability.lookup(occupancy.centres))
+
+  def connect_in_background(self):
+      try:
+          self.connect()
+          # then whatever was queued up by when_connected, in order
+          while True:
+              with self.deferred_lock:
+                  if not self.deferred:
+                      self.connected = True
+                      return
+                  call = self.deferred.pop(0)
+              call()
+      except Exception:
+          self.connection_error = sys.exc_info()
+
+  def when_connected(self, call):
+      ## Runs `call` now if the arm is connected, otherwise right after
+      ## the background connection is up, without waiting for it here.
+      with self.deferred_lock:
+          if not self.connected and self.connection_error is None:
+              self.deferred.append(call)
+              return
+      call()
+
+  def wait_until_connected(self):
+      ## Returns once connect() and everything queued by when_connected
+      ## have run. The public attributes appear before that, so whatever
+      ## plans or moves calls this first.
+      if self.connection is not None and threading.current_thread() is not self.connection:
+          self.connection.join()
+      if self.connection_error is not None:
+          error = self.connection_error
+          raise error[0], error[1], error[2]
+
+  def __getattr__(self, name):
+      # only called for attributes that do not exist (yet): those set by
+      # connect() on a lazy arm are waited for
+      connection = self.__dict__.get('connection')
+      if connection is None or name.startswith('__') or threading.current_thread() is connection:
+          raise AttributeError(name)
+      self.wait_until_connected()
+      if name not in self.__dict__:
+          raise AttributeError(name)
+      return self.__dict__[name]
+
+  global plan_move
+  def plan_move(move_group, waypoints, obj_attached, start_pose):
+      ## Cartesian plan through `waypoints` from `start_pose`: the stored
+      ## plan if there is one, otherwise the race or the retry loop.
+      ## Returns (plan, fraction, attempts, cache_key, cached_plan).
       fraction = 0.0
       maxtries = 10
       attempts = 0
-      if obj_attached:
-          sleeptime = 1
-      else:
-          sleeptime = 0.5
+      plan = None
       # raise_attempted = False
 
+      # repeated legs from the same start pose replay the stored plan
+      cache_key = plan_cache.make_key(start_pose, waypoints, EEF_STEP, obj_attached)
+      cached_plan = plan_cache.get(cache_key)
+      if cached_plan is None:
+          # legs between canonical poses come from the trajectory library
+          cached_plan = trajectory_library.lookup(cache_key, start_pose, waypoints, plan_cache.scene_state)
+          if cached_plan is not None:
+              cached_plan = retimer.retime(cached_plan, obj_attached)
+      if cached_plan is not None:
+          plan = cached_plan
+          fraction = 1.0
+      elif PLANNING_MODE == 'race':
+          with tracer.span('planning.race') as span:
+              (plan, fraction, attempts) = planning_race.race(move_group, waypoints, maxtries)
+              span.set(fraction=fraction, attempts=attempts)
+
       while fraction < 1.0 and attempts < maxtries:
-          (plan, fraction) = move_group.compute_cartesian_path(waypoints, 0.01, 0, True)
+          with tracer.span('planning.compute_cartesian_path', attempt=attempts + 1) as span:
+              (plan, fraction) = move_group.compute_cartesian_path(waypoints, EEF_STEP, JUMP_THRESHOLD, True)
+              span.set(fraction=fraction)
           attempts += 1
 
 
@@ -168,18 +2565,69 @@ class HouseholdPandaArm(object):
 
               break
 
+      # new plans are retimed once, the plan cache keeps them retimed
+      if cached_plan is None and fraction == 1.0:
+          plan = retimer.retime(plan, obj_attached)
 
+      return plan, fraction, attempts, cache_key, cached_plan
 
+  global execute_plan
+  def execute_plan(move_group, plan, waypoints, obj_attached, tracker=None, cached=False):
+      ## Runs a planned leg and waits for the arm to settle at its end.
+      ## Returns False if the controller refused the trajectory.
+      # carrying an object takes the controller a little longer to settle
+      if obj_attached:
+          settle_timeout = SETTLE_TIMEOUT
+      else:
+          settle_timeout = SETTLE_TIMEOUT * 0.5
 
-      if fraction == 1.0:
-          if obj_attached:
-              print "Path computed successfully. Moving the arm WITH OBJECT."
+      if obj_attached:
+          print "Path computed successfully. Moving the arm WITH OBJECT."
+      else:
+          print "Path computed successfully. Moving the arm."
+
+      with tracer.span('motion.execute', attached=bool(obj_attached), cached=cached):
+          executed = move_group.execute(plan, wait=True)
+      if executed is False:
+          # nothing moved, or the arm is not where we thought: read it back
+          if tracker is not None:
+              tracker.invalidate()
+          print "Controller refused the trajectory."
+          return False
+
+      with tracer.span('motion.settle'):
+          settled = wait_for_goal_reached(move_group, plan, settle_timeout)
+      if tracker is not None:
+          if settled:
+              tracker.update(waypoints[-1])
           else:
-              print "Path computed successfully. Moving the arm."
+              tracker.invalidate()
+      if not settled:
+          print "Arm did not settle at the goal within " + str(settle_timeout) + "s."
+      print "Path execution complete."
 
-          move_group.execute(plan)
-          time.sleep(sleeptime)
-          print "Path execution complete."
+      return executed
+
+  global perform_move
+  def perform_move(move_group, waypoints, obj_attached, tracker=None):
+      if tracker is not None:
+          start_pose = tracker.pose()
+      else:
+          start_pose = move_group.get_current_pose().pose
+      (plan, fraction, attempts, cache_key, cached_plan) = plan_move(move_group, waypoints, obj_attached, start_pose)
+
+      if fraction == 1.0:
+          executed = execute_plan(move_group, plan, waypoints, obj_attached, tracker, cached_plan is not None)
+          if executed is False and cached_plan is not None:
+              # stored plan no longer matches the robot state, plan it afresh
+              plan_cache.discard(cache_key)
+              trajectory_library.discard(cache_key)
+              return perform_move(move_group, waypoints, obj_attached, tracker)
+          if executed is False:
+              return False
+
+          # only plans that actually ran are kept
+          plan_cache.put(cache_key, plan)
 
 
           return True
@@ -188,11 +2636,14 @@ class HouseholdPandaArm(object):
           return False
 
   global set_waypoints
-  def set_waypoints(self, move_group, coordinates, obj_attached):
+  def set_waypoints(self, move_group, coordinates, obj_attached, start_pose=None):
       waypoints = []
 
       #first move to object
-      wpose = move_group.get_current_pose().pose
+      if start_pose is None:
+          wpose = self.pose_tracker.pose()
+      else:
+          wpose = copy.deepcopy(start_pose)
 
       if obj_attached:
           wpose.position.z += (self.obj_height + 0.05)
@@ -215,6 +2666,7 @@ class HouseholdPandaArm(object):
 
 
   def calibrate_arm(self):
+      self.wait_until_connected()
       move_group = self.move_group
 
 
@@ -224,7 +2676,7 @@ class HouseholdPandaArm(object):
 
       waypoints = []
 
-      wpose = move_group.get_current_pose().pose
+      wpose = self.pose_tracker.pose()
       wpose.position.y -= (table_size_y / 2)
       wpose.position.x -= (table_size_x / 2)
       waypoints.append(copy.deepcopy(wpose))
@@ -250,7 +2702,7 @@ class HouseholdPandaArm(object):
       wpose.position.y = self.table_y
       waypoints.append(copy.deepcopy(wpose))
 
-      move = perform_move(move_group, waypoints, False)
+      move = perform_move(move_group, waypoints, False, self.pose_tracker)
 
 
 
@@ -258,41 +2710,27 @@ class HouseholdPandaArm(object):
 
   def attach_object(self, obj_name):
 
-    robot = self.robot
-    scene = self.scene
-    eef_link = self.eef_link
-    group_names = self.group_names
-
-
-    grasping_group = 'hand'
-    touch_links = robot.get_link_names(group=grasping_group)
-    scene.attach_box(eef_link, obj_name, touch_links=touch_links)
+    with tracer.span('scene.attach_object', object=obj_name):
+        with self.scene_batch() as batch:
+            batch.attach_box(obj_name)
 
     return
 
   def detach_object(self, obj_name):
 
-    scene = self.scene
-    eef_link = self.eef_link
-
-    move_group = self.move_group
-    current_pos = move_group.get_current_pose().pose
-    pos_x = float("%.2f" % (current_pos.position.x))
-    pos_y = float("%.2f" % (current_pos.position.y))
+    with tracer.span('scene.detach_object', object=obj_name):
+        move_group = self.move_group
+        current_pos = self.pose_tracker.pose()
+        pos_x = float("%.2f" % (current_pos.position.x))
+        pos_y = float("%.2f" % (current_pos.position.y))
 
 
-    if obj_name == 'plate':
-        self.plate_x = pos_x
-        self.plate_y = pos_y
-    elif obj_name == 'knife':
-        self.knife_x = pos_x
-        self.knife_y = pos_y
-    elif obj_name == 'fork':
-        self.fork_x = pos_x
-        self.fork_y = pos_y
+        self.objects.set_xy(obj_name, (pos_x, pos_y))
+        self.footprint_index.move(obj_name, (pos_x, pos_y))
 
 
-    scene.remove_attached_object(eef_link, name=obj_name)
+        with self.scene_batch() as batch:
+            batch.detach_box(obj_name, (pos_x, pos_y, self.obj_z_coordinate))
 
     return
 
@@ -301,30 +2739,141 @@ class HouseholdPandaArm(object):
 
   def add_object(self, obj_name, obj_xyz, obj_dims):
 
-    scene = self.scene
+    with tracer.span('scene.add_object', object=obj_name):
+        with self.scene_batch() as batch:
+            batch.add_box(obj_name, obj_xyz, obj_dims)
 
+    return
 
-    obj_pose = geometry_msgs.msg.PoseStamped()
-    obj_pose.header.frame_id = "panda_link0"
-    ##box_pose.pose.orientation.w = 1.0
-    obj_pose.pose.position.x = obj_xyz[0]
-    obj_pose.pose.position.y = obj_xyz[1]
-    obj_pose.pose.position.z = obj_xyz[2]
+  def scene_batch(self):
+      return SceneBatch(self)
+
+  def make_pose(self, obj_xyz):
+      obj_pose = geometry_msgs.msg.PoseStamped()
+      obj_pose.header.frame_id = "panda_link0"
+      obj_pose.pose.orientation.w = 1.0
+      obj_pose.pose.position.x = obj_xyz[0]
+      obj_pose.pose.position.y = obj_xyz[1]
+      obj_pose.pose.position.z = obj_xyz[2]
+
+      return obj_pose
+
+  def build_scene_diff(self, batch):
+      CollisionObject = moveit_msgs.msg.CollisionObject
+
+      diff = moveit_msgs.msg.PlanningScene()
+      diff.is_diff = True
+      diff.robot_state.is_diff = True
+
+      for obj_name in batch.removals:
+          obj = CollisionObject()
+          obj.id = obj_name
+          obj.header.frame_id = "panda_link0"
+          obj.operation = CollisionObject.REMOVE
+          diff.world.collision_objects.append(obj)
+
+      for obj_name, obj_xyz, obj_dims in batch.boxes:
+          box = shape_msgs.msg.SolidPrimitive()
+          box.type = shape_msgs.msg.SolidPrimitive.BOX
+          box.dimensions = list(obj_dims)
+
+          obj = CollisionObject()
+          obj.id = obj_name
+          obj.header.frame_id = "panda_link0"
+          obj.primitives = [box]
+          obj.primitive_poses = [self.make_pose(obj_xyz).pose]
+          obj.operation = CollisionObject.ADD
+          diff.world.collision_objects.append(obj)
+
+      if batch.attaches:
+          touch_links = self.robot.get_link_names(group='hand')
+
+      for obj_name, obj_xyz in batch.detaches:
+          attached = moveit_msgs.msg.AttachedCollisionObject()
+          attached.link_name = self.eef_link
+          attached.object.id = obj_name
+          attached.object.operation = CollisionObject.REMOVE
+          diff.robot_state.attached_collision_objects.append(attached)
+
+      for obj_name in batch.attaches:
+          # an ADD with only an id attaches the existing world object
+          attached = moveit_msgs.msg.AttachedCollisionObject()
+          attached.link_name = self.eef_link
+          attached.object.id = obj_name
+          attached.object.operation = CollisionObject.ADD
+          attached.touch_links = touch_links
+          diff.robot_state.attached_collision_objects.append(attached)
+
+      return diff
+
+  def apply_scene_batch(self, batch):
+      applied = self.backend.apply_scene_batch(self, batch)
+      if not applied:
+          print("Planning scene diff rejected, applying changes one by one.")
+          self.apply_scene_changes_individually(batch)
+
+      for obj_name in batch.removals:
+          self.world.pop(obj_name, None)
+      for obj_name, obj_xyz, obj_dims in batch.boxes:
+          self.world[obj_name] = (obj_xyz, obj_dims)
+      for obj_name, obj_xyz in batch.detaches:
+          obj_dims = self.world[obj_name][1]
+          self.world[obj_name] = (obj_xyz, obj_dims)
+          self.attached_obj = None
+          if obj_name in self.objects:
+              self.objects.set_attached(obj_name, False)
+      for obj_name in batch.attaches:
+          self.attached_obj = obj_name
+          if obj_name in self.objects:
+              self.objects.set_attached(obj_name, True)
+
+      self.scene_changed()
+
+      return applied
+
+  def apply_scene_changes_individually(self, batch):
+      scene = self.scene
+      eef_link = self.eef_link
+
+      for obj_name in batch.removals:
+          scene.remove_world_object(obj_name)
+          self.wait_for_scene_update(obj_name)
+
+      for obj_name, obj_xyz, obj_dims in batch.boxes:
+          # messages published before the scene publisher has connected are
+          # dropped, so publish again until the object shows up
+          for attempt in range(3):
+              scene.add_box(obj_name, self.make_pose(obj_xyz), size=obj_dims)
+              if self.wait_for_scene_update(obj_name, obj_is_known=True):
+                  break
+          else:
+              print("Object " + obj_name + " did not appear in the planning scene.")
 
-    scene.add_box(obj_name, obj_pose, size=(obj_dims[0], obj_dims[1], obj_dims[2]))
+      for obj_name, obj_xyz in batch.detaches:
+          scene.remove_attached_object(eef_link, name=obj_name)
+          if not self.wait_for_scene_update(obj_name, obj_is_known=True):
+              print("Detach of " + obj_name + " not acknowledged by the planning scene.")
 
-    return
+      for obj_name in batch.attaches:
+          touch_links = self.robot.get_link_names(group='hand')
+          scene.attach_box(eef_link, obj_name, touch_links=touch_links)
+          if not self.wait_for_scene_update(obj_name, obj_is_attached=True):
+              print("Attach of " + obj_name + " not acknowledged by the planning scene.")
+
+  def wait_for_scene_update(self, obj_name, obj_is_known=False, obj_is_attached=False, timeout=SCENE_TIMEOUT):
+      scene = self.scene
+
+      def updated():
+          is_attached = len(scene.get_attached_objects([obj_name]).keys()) > 0
+          is_known = obj_name in scene.get_known_object_names()
+
+          return (obj_is_attached == is_attached) and (obj_is_known == is_known)
+
+      return wait_for(updated, timeout)
 
   def check_object(self, obj_name, rightful_coordinates, obj_notattached):
-      if obj_name == 'plate':
-          pos_x = self.plate_x
-          pos_y = self.plate_y
-      elif obj_name == 'knife':
-          pos_x = self.knife_x
-          pos_y = self.knife_y
-      elif obj_name == 'fork':
-          pos_x = self.fork_x
-          pos_y = self.fork_y
+      self.wait_until_connected()
+      pos_x, pos_y = self.objects.get_xy(obj_name)
 
       if (pos_x == rightful_coordinates[0]) and (pos_y == rightful_coordinates[1]):
           return True
@@ -334,13 +2883,75 @@ class HouseholdPandaArm(object):
 
           waypoints = set_waypoints(self, move_group, coordinates, obj_notattached)
 
-          move = perform_move(move_group, waypoints, obj_notattached)
+          move = perform_move(move_group, waypoints, obj_notattached, self.pose_tracker)
 
           return False
 
 
 
 
+  def object_positions(self):
+      objects = self.objects
+      return dict((obj_name, objects.get_xy(obj_name)) for obj_name in objects)
+
+  def object_footprints(self):
+      objects = self.objects
+      return dict((obj_name, objects.footprint(obj_name)) for obj_name in objects)
+
+  def sort_objects(self, targets, max_rounds=3):
+      ## Plan the full rearrangement and carry it out. If a move fails the
+      ## objects are re-read and the remaining moves planned again.
+      # nothing is planned before the deferred scene changes are in
+      self.wait_until_connected()
+      planner = self.rearrangement_planner
+
+      out_of_reach = sorted(obj_name for obj_name, xy in targets.items() if not self.reachability.reachable(xy))
+      if out_of_reach:
+          print("Cannot sort objects: goals out of reach for " + ", ".join(out_of_reach))
+          return False
+
+      for sort_round in range(max_rounds):
+          current = self.object_positions()
+          try:
+              with tracer.span('sort.plan', round=sort_round):
+                  p = self.pose_tracker.pose().position
+                  moves = planner.plan(current, targets, self.object_footprints(), (p.x, p.y, p.z))
+          except (ValueError, RuntimeError) as e:
+              print("Cannot sort objects: " + str(e))
+              return False
+
+          if not moves:
+              return True
+
+          for obj_name in sorted(targets.keys()):
+              if planner.in_place(current[obj_name], targets[obj_name]):
+                  print(obj_name + " done")
+          print("Rearrangement plan: " + str(len(moves)) + " moves")
+
+          for position, (obj_name, destination, is_buffer) in enumerate(moves):
+              if is_buffer:
+                  print(obj_name + " to buffer " + str(destination))
+              else:
+                  print(obj_name + " now")
+              with tracer.span('sort.move', object=obj_name, buffer=is_buffer):
+                  if MOTION_MODE == 'stitched':
+                      self.pick_and_place(obj_name, destination)
+                  elif MOTION_MODE == 'pipelined':
+                      if position + 1 < len(moves):
+                          next_obj = moves[position + 1][0]
+                      else:
+                          next_obj = None
+                      self.pipelined_move(obj_name, destination, next_obj)
+                  else:
+                      self.move_leg_by_leg(obj_name, destination)
+                  self.detach_object(obj_name)
+
+      current = self.object_positions()
+      for obj_name in targets:
+          if not planner.in_place(current[obj_name], targets[obj_name]):
+              return False
+      return True
+
   def getRandomFloat(self, type):
       if type == 'x':
           lower = self.table_lower_x + 0.1
@@ -367,263 +2978,1471 @@ class HouseholdPandaArm(object):
   global intersect_check
   def intersect_check(self, obj_id, rightful_coordinates):
 
-      x,y = rightful_coordinates
+      # only objects sharing a grid cell with the candidate footprint are
+      # compared against it
+      index = self.footprint_index
+      half = index.half_extents(obj_id)
+      with tracer.span('placement.intersect_check', object=obj_id):
+          hits = index.query(rightful_coordinates, half, exclude=obj_id)
 
-      check1 = False
-      check2 = False
-      position_free = False
+      position_free = len(hits) == 0
 
-      p_x = self.plate_x
-      p_y = self.plate_y
-      p_depth = self.plate_size_x / 2
-      k_x = self.knife_x
-      k_y = self.knife_y
-      k_depth = self.knife_size_x / 2
-      f_x = self.fork_x
-      f_y = self.fork_y
-      f_depth = self.fork_size_x / 2
-      obj_width = self.obj_width
+      return position_free
 
-      plate_x_boundaries = [(p_x - p_depth), (p_x + p_depth)]
-      plate_y_boundaries = [(p_y - obj_width), (p_y + obj_width)]
-      knife_x_boundaries = [(k_x - k_depth), (k_x + k_depth)]
-      knife_y_boundaries = [(k_y - obj_width), (k_y + obj_width)]
-      fork_x_boundaries = [(f_x - f_depth), (f_x + f_depth)]
-      fork_y_boundaries = [(f_y - obj_width), (f_y + obj_width)]
 
-      if obj_id == 'plate' :
-          plate_x_boundaries = [(x - p_depth), (x + p_depth)]
-          plate_y_boundaries = [(y - obj_width), (y + obj_width)]
+  def goals_on_table(self, targets):
+      # every goal inside the table bounds and within reach, and no two
+      # goals the same
+      for obj_name, xy in targets.items():
+          if not self.table_lower_x <= xy[0] <= self.table_upper_x:
+              return False
+          if not self.table_lower_y <= xy[1] <= self.table_upper_y:
+              return False
+          if not self.reachability.reachable(xy):
+              return False
+
+      return len(set(targets.values())) == len(targets)
+
+  def free_destination(self, obj_id, rightful_coordinates):
+      # rightful_coordinates if obj_id fits there, else the nearest free
+      # position (None if there is none)
+      if intersect_check(self, obj_id, rightful_coordinates):
+          return rightful_coordinates
+
+      print(">>>>>>>>>>>>>>> SPACE TAKEN, moving to the nearest free position for now")
+      index = self.footprint_index
+      with tracer.span('placement.search', object=obj_id):
+          # the quickest detour on the way to where it belongs
+          start = self.objects.get_xy(obj_id)
+          cost = lambda centres: self.motion_cost.detour_time(start, centres, rightful_coordinates)
+          new_coordinates = self.buffer_map.nearest_free(index.half_extents(obj_id), index,
+                                                         rightful_coordinates, exclude=obj_id, cost=cost)
+      if new_coordinates is None:
+          print(">>>>>>>>>>>>>>> NO SPACE on the table for " + obj_id)
+      else:
+          print("New Space Found")
 
-          main_obj = [plate_x_boundaries, plate_y_boundaries]
+      return new_coordinates
 
-          obj1 = [knife_x_boundaries, knife_y_boundaries]
-          obj2 = [fork_x_boundaries, fork_y_boundaries]
+  def try_move_to_goal(self, obj_id, rightful_coordinates, obj_attached):
+      self.wait_until_connected()
+      coordinates = self.free_destination(obj_id, rightful_coordinates)
+      if coordinates is None:
+          return False
 
+      move_group = self.move_group
+      waypoints = set_waypoints(self, move_group, coordinates, obj_attached)
+      move = perform_move(move_group, waypoints, obj_attached, self.pose_tracker)
+
+      return move
+
+  def move_leg_by_leg(self, obj_id, rightful_coordinates):
+      self.check_object(obj_id, rightful_coordinates, False)
+      self.attach_object(obj_id)
+      return self.try_move_to_goal(obj_id, rightful_coordinates, True)
+
+  def pipelined_move(self, obj_id, rightful_coordinates, next_obj=None):
+      ## Leg-by-leg move with planning overlapped with execution: the
+      ## transport leg is planned while the approach runs, and the next
+      ## object's approach while the transport runs. A plan made ahead is
+      ## only used if the arm and the objects ended up where they were
+      ## predicted to be; otherwise the leg is planned again from where
+      ## the arm actually is.
+      self.wait_until_connected()
+      move_group = self.move_group
+      tracker = self.pose_tracker
+      pipeline = self.planning_pipeline
+
+      approach = self.take_prefetched(obj_id)
+      coordinates = self.free_destination(obj_id, rightful_coordinates)
+      if coordinates is None:
+          return self.move_leg_by_leg(obj_id, rightful_coordinates)
+
+      pick = self.objects.get_xy(obj_id)
+      approach_waypoints = set_waypoints(self, move_group, pick, False)
+      approach_key = None
+      if approach is None:
+          (approach, fraction, attempts, approach_key, cached) = plan_move(move_group, approach_waypoints, False,
+                                                                           tracker.pose())
+          if fraction < 1.0:
+              return self.move_leg_by_leg(obj_id, rightful_coordinates)
+
+      transport_waypoints = set_waypoints(self, move_group, coordinates, True, approach_waypoints[-1])
+      pending = pipeline.submit(transport_waypoints,
+                                self.backend.predicted_start_state(self, approach, attach=obj_id))
+
+      executed = execute_plan(move_group, approach, approach_waypoints, False, tracker)
+      (transport, fraction) = pending.result()
+      if executed is False:
+          if approach_key is not None:
+              plan_cache.discard(approach_key)
+          return self.move_leg_by_leg(obj_id, rightful_coordinates)
+      if approach_key is not None:
+          plan_cache.put(approach_key, approach)
+      self.attach_object(obj_id)
+
+      if fraction < 1.0 or tracker.tracked is None:
+          # no plan from the predicted pick pose, or the arm is elsewhere
+          return self.try_move_to_goal(obj_id, coordinates, True)
+      transport = retimer.retime(transport, True)
+
+      if next_obj is not None:
+          if next_obj == obj_id:
+              next_pick = coordinates
+          else:
+              next_pick = self.objects.get_xy(next_obj)
+          next_waypoints = set_waypoints(self, move_group, next_pick, False, transport_waypoints[-1])
+          next_pending = pipeline.submit(next_waypoints,
+                                         self.backend.predicted_start_state(self, transport, detach=obj_id))
+          self.prefetched = (next_obj, transport_waypoints[-1], obj_id, coordinates, next_pending)
+
+      executed = execute_plan(move_group, transport, transport_waypoints, True, tracker)
+      if executed is False:
+          self.take_prefetched(None)
+          return self.try_move_to_goal(obj_id, coordinates, True)
+
+      return True
+
+  def take_prefetched(self, obj_id):
+      # the approach to obj_id planned during the previous move, if it
+      # still starts where the arm is and the object put down then is
+      # where it was expected
+      if self.prefetched is None:
+          return None
+      (next_obj, start_pose, placed_obj, placed_xy, pending) = self.prefetched
+      self.prefetched = None
+      (plan, fraction) = pending.result()
+
+      if next_obj != obj_id or fraction < 1.0:
+          return None
+      tracked = self.pose_tracker.tracked
+      if tracked is None or plan_cache.quantize(tracked) != plan_cache.quantize(start_pose):
+          return None
+      if not self.rearrangement_planner.in_place(self.objects.get_xy(placed_obj), placed_xy):
+          return None
+
+      return retimer.retime(plan, False)
+
+  def pick_and_place(self, obj_id, rightful_coordinates):
+      ## Approach, pick and transport as one trajectory. Both legs are
+      ## planned up front, the transport leg from the pick pose with the
+      ## object already held. The corners are blended so the arm does not
+      ## stop at every waypoint, only at the pick itself, where the object
+      ## is attached while the trajectory runs on. Falls back to separate
+      ## legs if either part cannot be planned.
+      self.wait_until_connected()
+      move_group = self.move_group
+      tracker = self.pose_tracker
 
-      elif obj_id == 'knife' :
-          knife_x_boundaries = [(x - k_depth), (x + k_depth)]
-          knife_y_boundaries = [(y - obj_width), (y + obj_width)]
+      coordinates = self.free_destination(obj_id, rightful_coordinates)
+      if coordinates is None:
+          return False
 
-          main_obj = [knife_x_boundaries, knife_y_boundaries]
+      with tracer.span('stitch.plan', object=obj_id) as span:
+          pick = self.objects.get_xy(obj_id)
+          approach_waypoints = set_waypoints(self, move_group, pick, False)
+          (approach, fraction, attempts, approach_key, cached) = plan_move(move_group, approach_waypoints, False,
+                                                                           tracker.pose())
+          if fraction == 1.0:
+              pick_pose = approach_waypoints[-1]
+              transport_waypoints = set_waypoints(self, move_group, coordinates, True, pick_pose)
+              move_group.set_start_state(self.backend.predicted_start_state(self, approach, attach=obj_id))
+              try:
+                  (transport, fraction, attempts, transport_key, cached) = plan_move(
+                      move_group, transport_waypoints, True, pick_pose)
+              finally:
+                  move_group.set_start_state_to_current_state()
+          span.set(fraction=fraction)
+
+      if fraction < 1.0:
+          print("Stitched path planning UNSUCCESSFUL, moving " + obj_id + " leg by leg.")
+          return self.move_leg_by_leg(obj_id, rightful_coordinates)
+
+      plan_cache.put(approach_key, approach)
+      plan_cache.put(transport_key, transport)
+
+      with tracer.span('stitch.blend'):
+          approach_points = trajectory_positions(approach)
+          transport_points = trajectory_positions(transport)
+          path = np.vstack((approach_points, transport_points[1:]))
+          path, (pick_index,) = blend_corners(path, BLEND_RADIUS, keep=[len(approach_points) - 1])
+          times = time_parameterize(path, STITCH_VELOCITY, STITCH_ACCELERATION, stops=[pick_index])
+          plan = self.backend.make_trajectory(approach, path, times)
+
+      print("Path computed successfully. Picking and placing " + obj_id + " in one motion.")
+      with tracer.span('motion.execute', stitched=True):
+          executed = self.backend.execute_with_events(self, plan, [(pick_index, lambda: self.attach_object(obj_id))])
+      if not executed:
+          # a stored plan that no longer starts where the arm is
+          tracker.invalidate()
+          plan_cache.discard(approach_key)
+          plan_cache.discard(transport_key)
+          return self.move_leg_by_leg(obj_id, rightful_coordinates)
+
+      # execute_with_events may return at the pick while the transport part
+      # is still running, so wait for the rest of the trajectory as well
+      settle_timeout = float(times[-1] - times[pick_index]) + SETTLE_TIMEOUT
+      with tracer.span('motion.settle'):
+          settled = wait_for_goal_reached(move_group, plan, settle_timeout)
+      if settled:
+          tracker.update(transport_waypoints[-1])
+      else:
+          tracker.invalidate()
+          print "Arm did not settle at the goal within " + str(settle_timeout) + "s."
+      print "Path execution complete."
 
-          obj1 = [plate_x_boundaries, plate_y_boundaries]
-          obj2 = [fork_x_boundaries, fork_y_boundaries]
+      return True
 
+  def random_layout(self, obj_names, seed=None):
+      ## Random, non-overlapping start positions; the same seed gives the
+      ## same layout.
+      footprints = self.object_footprints()
 
-      elif obj_id == 'fork' :
-          fork_x_boundaries = [(x - f_depth), (x + f_depth)]
-          fork_y_boundaries = [(y - obj_width), (y + obj_width)]
+      return self.layout_generator.generate([(obj_name, footprints[obj_name]) for obj_name in obj_names], seed)
 
-          main_obj = [fork_x_boundaries, fork_y_boundaries]
+  def set_coordinates(self, obj_name, coordinates):
+      self.objects.set_xy(obj_name, coordinates)
+      self.footprint_index.move(obj_name, coordinates)
 
-          obj1 = [plate_x_boundaries, plate_y_boundaries]
-          obj2 = [knife_x_boundaries, knife_y_boundaries]
+  def scene_changed(self):
+      # fingerprint of everything that affects a plan: the objects in the
+      # scene, where they are and which one is held
+      scene_state = (tuple(sorted(self.world.items())), self.attached_obj)
+      plan_cache.set_scene(scene_state)
 
+  def home_waypoints(self, start_pose):
+      waypoints = []
 
-      intersection_x1 = intersection(main_obj[0], obj1[0])
-      intersection_y1 = intersection(main_obj[1], obj1[1])
-      intersection_x2 = intersection(main_obj[0], obj2[0])
-      intersection_y2 = intersection(main_obj[1], obj2[1])
+      wpose = copy.deepcopy(start_pose)
 
-      if intersection_x1 == 0:
-          check1 = True
+      wpose.position.z = self.z_coordinate_above_obj + 0.2
+      waypoints.append(copy.deepcopy(wpose))
 
-      elif intersection_y1 == 0:
-          check1 = True
+      wpose.position.x = 0.4
+      waypoints.append(copy.deepcopy(wpose))
 
-      if intersection_x2 == 0:
-          check2 = True
+      wpose.position.y = 0
+      waypoints.append(copy.deepcopy(wpose))
 
-      elif intersection_y2 == 0:
-          check2 = True
+      return waypoints
 
-      if check1 and check2:
-          position_free = True
+  def finish_move(self):
+      self.wait_until_connected()
+      move_group = self.move_group
+      waypoints = self.home_waypoints(self.pose_tracker.pose())
 
+      with tracer.span('sort.finish_move'):
+          move = perform_move(move_group, waypoints, False, self.pose_tracker)
+      print(plan_cache.report())
+      if trajectory_library.entries:
+          print(trajectory_library.report())
+      if retimer.enabled:
+          print(retimer.report())
 
-      return position_free
 
 
-  def try_move_to_goal(self, obj_id, rightful_coordinates, obj_attached):
-      check = intersect_check(self, obj_id, rightful_coordinates)
+###############################################################################
+###############################################################################
+#############################  MAIN BELOW  ####################################
+###############################################################################
+###############################################################################
 
-      move_group = self.move_group
+def setup_scene(DinnerTablePanda, seed=None):
+  # random start positions, adequately spaced apart
+  objects = DinnerTablePanda.objects
+  layout = DinnerTablePanda.random_layout(list(objects), seed)
 
-      if check:
-          waypoints = set_waypoints(self, move_group, rightful_coordinates, obj_attached)
+  # initiailise object characteristics
+  table_name = DinnerTablePanda.table_name
+  table_coordinates = (DinnerTablePanda.table_x, DinnerTablePanda.table_y, DinnerTablePanda.table_z)
+  table_dimensions = (DinnerTablePanda.table_size_x, DinnerTablePanda.table_size_y, DinnerTablePanda.table_size_z)
 
-          move = perform_move(move_group, waypoints, obj_attached)
+  #set the initial random positions of the objets
+  for obj_name in objects:
+      DinnerTablePanda.set_coordinates(obj_name, layout[obj_name])
 
-      else:
-          temp_place_found = False
-          while not temp_place_found:
-
-              print(">>>>>>>>>>>>>>> SPACE TAKEN, moving to a random position for now")
-              temp_place_found = False
-              new_x = random.uniform((self.table_lower_x + 0.12), (self.table_upper_x - 0.12))
-              new_x_float = float("%.2f" % new_x)
-              new_y = random.uniform((self.table_lower_y + 0.05), (self.table_upper_y - 0.05))
-              new_y_float = float("%.2f" % new_y)
-              new_coordinates = (new_x_float, new_y_float)
-
-              check = intersect_check(self, obj_id, new_coordinates)
-              if check:
-                  waypointsB = set_waypoints(self, move_group, new_coordinates, obj_attached)
-                  moveB = perform_move(move_group, waypointsB, obj_attached)
-                  print("New Space Found")
-
-                  temp_place_found = True
-      return
+  print "============ Adding table and " + str(len(objects)) + " objects ..."
+  with tracer.span('scene.setup', objects=len(objects)):
+      batch = DinnerTablePanda.scene_batch()
+      batch.add_box(table_name, table_coordinates, table_dimensions)
+      for obj_name in objects:
+          batch.add_box(obj_name, objects.get_xyz(obj_name), objects.get_size(obj_name))
 
-  def set_coordinates(self, obj_name, coordinates):
-      if obj_name == self.plate_name:
-          self.plate_x = coordinates[0]
-          self.plate_y = coordinates[1]
-      elif obj_name == self.knife_name:
-          self.knife_x = coordinates[0]
-          self.knife_y = coordinates[1]
-      elif obj_name == self.fork_name:
-          self.fork_x = coordinates[0]
-          self.fork_y = coordinates[1]
+  # a lazy arm may still be connecting, the scene goes in once it is up
+  DinnerTablePanda.when_connected(batch.commit)
 
-  def finish_move(self):
-      move_group = self.move_group
 
-      waypoints = []
+# Goals used for headless runs: the EASY-mode layout with the knife and
+# fork on different sides of the plate
+DEFAULT_GOALS = {"plate": (0.4, 0), "knife": (0.4, -0.2), "fork": (0.4, 0.2)}
 
-      wpose = move_group.get_current_pose().pose
 
-      wpose.position.z = self.z_coordinate_above_obj + 0.2
-      waypoints.append(copy.deepcopy(wpose))
+def easy_goals(knife_side, fork_side):
+  # EASY mode: the plate in the middle, the knife and fork to its LEFT
+  # or RIGHT
+  plate_coordinates = (0.4, 0)
 
-      wpose.position.x = 0.4
-      waypoints.append(copy.deepcopy(wpose))
+  if knife_side == fork_side:
+      if knife_side == "RIGHT":
+          fork_coordinates = (0.4, 0.18)
+          knife_coordinates = (0.4, 0.3)
+      else:
+          knife_coordinates = (0.4, -0.18)
+          fork_coordinates = (0.4, -0.3)
 
-      wpose.position.y = 0
-      waypoints.append(copy.deepcopy(wpose))
+  else:
+      if knife_side == "RIGHT":
+          knife_coordinates = (0.4, 0.2)
+          fork_coordinates = (0.4, -0.2)
+      else:
+          knife_coordinates = (0.4, -0.2)
+          fork_coordinates = (0.4, 0.2)
 
+  return {"plate": plate_coordinates, "knife": knife_coordinates, "fork": fork_coordinates}
 
 
-      move = perform_move(move_group, waypoints, False)
+class EasyDemos(object):
+  """EasyDemos"""
+  ## Tally of the knife and fork sides over the EASY demos. On a tie the
+  ## side that was demonstrated first wins.
+  def __init__(self):
+      self.count = 0
+      self.sides = {"knife": Counter(), "fork": Counter()}
+      self.first_seen = {}
+
+  def add(self, knife_side, fork_side):
+      self.sides["knife"][knife_side] += 1
+      self.sides["fork"][fork_side] += 1
+      if len(self.first_seen) < 4:
+          self.first_seen.setdefault(("knife", knife_side), self.count)
+          self.first_seen.setdefault(("fork", fork_side), self.count)
+      self.count += 1
+
+  def most_common(self, obj_name):
+      counts = self.sides[obj_name]
+      return min(counts, key=lambda side: (-counts[side], self.first_seen[(obj_name, side)]))
+
+  def goals(self):
+      return easy_goals(self.most_common("knife"), self.most_common("fork"))
+
+
+def exact_quantile(values, p):
+  # linear interpolation between the closest ranks
+  values = sorted(values)
+  position = p * (len(values) - 1)
+  lower = int(position)
+  upper = min(lower + 1, len(values) - 1)
+
+  return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+class RobustEstimator(object):
+  """RobustEstimator"""
+  ## Online location estimate of one coordinate in O(1) memory. `kind` is
+  ## 'mean', 'median' or 'trimmed', a mean that leaves out the `trim`
+  ## fraction at either end; the mean and variance are always kept
+  ## (Welford). Demo coordinates are given to the centimetre and lie on
+  ## the table, so the median and trimmed mean come from a histogram with
+  ## one bin per `resolution` between `low` and `high`, which gives the
+  ## same answer whatever order the demos arrive in. Values outside count
+  ## in the edge bins; they could never be a goal anyway. The first
+  ## `exact_limit` values are also kept as they are, so the usual handful
+  ## of demos gives estimates below the centimetre.
+  def __init__(self, kind='median', trim=0.2, exact_limit=32, low=-1.0, high=1.0, resolution=0.01):
+      self.kind = kind
+      self.trim = trim
+      self.exact_limit = exact_limit
+      self.values = []
+      self.count = 0
+      self.mean = 0.0
+      self.m2 = 0.0
+      self.low = low
+      self.resolution = resolution
+      # only the median and trimmed mean need the histogram
+      if kind == 'mean':
+          self.bins = None
+      else:
+          self.bins = [0] * (int(round((high - low) / resolution)) + 1)
 
+  def add(self, x):
+      self.count += 1
+      delta = x - self.mean
+      self.mean += delta / self.count
+      self.m2 += delta * (x - self.mean)
+
+      if self.bins is not None:
+          index = int(round((x - self.low) / self.resolution))
+          self.bins[min(max(index, 0), len(self.bins) - 1)] += 1
+
+      if self.values is not None:
+          if len(self.values) < self.exact_limit:
+              self.values.append(x)
+          else:
+              self.values = None
+
+  def variance(self):
+      if self.count < 2:
+          return 0.0
+      return self.m2 / (self.count - 1)
+
+  def value_at(self, rank):
+      # the value with the given 0-based rank in the histogram
+      index = int(np.searchsorted(np.cumsum(self.bins), rank, side='right'))
+      return self.low + index * self.resolution
+
+  def estimate(self):
+      if self.kind == 'mean':
+          return self.mean
+
+      if self.values is not None:
+          values = sorted(self.values)
+          if self.kind == 'median':
+              return exact_quantile(values, 0.5)
+          cut = int(self.trim * len(values))
+          kept = values[cut:len(values) - cut]
+          return sum(kept) / len(kept)
+
+      if self.kind == 'median':
+          position = 0.5 * (self.count - 1)
+          lower = self.value_at(int(position))
+          upper = self.value_at(min(int(position) + 1, self.count - 1))
+          return lower + (upper - lower) * (position - int(position))
+
+      # how many of each bin's values fall within ranks [cut, count - cut)
+      cut = int(self.trim * self.count)
+      counts = np.array(self.bins)
+      after = np.cumsum(counts)
+      kept = np.clip(np.minimum(after, self.count - cut) - np.maximum(after - counts, cut), 0, None)
+      centres = self.low + np.arange(len(counts)) * self.resolution
+      return float((kept * centres).sum() / kept.sum())
+
+
+def check_goal_estimators(count=1000):
+  ## Regression check of the streaming estimates beyond `exact_limit`:
+  ## sorted, reversed and shuffled streams must agree with each other and
+  ## with the exact values, and demos drifting from 0.3 to 0.5 (slowly at
+  ## first, so the mean, median and trimmed mean differ) must give the
+  ## goal those values round to. Returns whether they all do.
+  values = [float("%.2f" % (0.3 + 0.2 * (float(k) / (count - 1)) ** 2)) for k in range(count)]
+  shuffled = list(values)
+  random.Random(0).shuffle(shuffled)
+  cut = int(0.2 * count)
+  expected = {'mean': sum(values) / count,
+              'median': exact_quantile(values, 0.5),
+              'trimmed': sum(sorted(values)[cut:count - cut]) / (count - 2 * cut)}
+
+  passed = True
+  for kind in ['mean', 'median', 'trimmed']:
+      for name, stream in [('ascending', values), ('descending', values[::-1]), ('shuffled', shuffled)]:
+          estimator = RobustEstimator(kind)
+          for x in stream:
+              estimator.add(x)
+          error = abs(estimator.estimate() - expected[kind])
+          ok = error < 1e-6
+          passed = passed and ok
+          print("{:<8} {:<11} {:.4f} (exact {:.4f}) {}".format(
+              kind, name, estimator.estimate(), expected[kind], "ok" if ok else "WRONG"))
+
+      demos = AdvancedDemos(kind)
+      for x in values:
+          demos.add('plate', (x, 0.0))
+      ok = demos.goal('plate') == (float("%.2f" % expected[kind]), 0.0)
+      passed = passed and ok
+      print("{:<8} {:<11} {} {}".format(kind, "drift goal", demos.goal('plate'), "ok" if ok else "WRONG"))
+
+  print("Estimators agree" if passed else "ESTIMATORS DISAGREE")
+  return passed
+
+
+# How ADVANCED demos are combined into a goal: 'mean', 'median' or
+# 'trimmed'. The robust ones keep a stray demo from dragging a goal away.
+GOAL_ESTIMATOR = 'median'
+
+
+class AdvancedDemos(object):
+  """AdvancedDemos"""
+  ## Online estimate of each object's goal from the demonstrated (x, y),
+  ## updated as every demo arrives; goal() can be asked at any time.
+  def __init__(self, estimator=None):
+      if estimator is None:
+          estimator = GOAL_ESTIMATOR
+      if estimator not in ('mean', 'median', 'trimmed'):
+          raise ValueError("unknown goal estimator: %s" % estimator)
+      self.estimator = estimator
+      self.count = 0
+      self.coordinates = {}
+
+  def add(self, obj_name, xy):
+      if obj_name not in self.coordinates:
+          self.coordinates[obj_name] = (RobustEstimator(self.estimator), RobustEstimator(self.estimator))
+      x_estimator, y_estimator = self.coordinates[obj_name]
+      x_estimator.add(xy[0])
+      y_estimator.add(xy[1])
+
+  def goal(self, obj_name):
+      x_estimator, y_estimator = self.coordinates[obj_name]
+      x = x_estimator.estimate()
+      y = y_estimator.estimate()
+
+      # + 0.0 keeps a goal at -0.001 from printing as -0.0
+      return (float("%.2f" % x) + 0.0, float("%.2f" % y) + 0.0)
+
+  def spread(self, obj_name):
+      # standard deviation of the demos along x and y
+      x_estimator, y_estimator = self.coordinates[obj_name]
+      return (sqrt(x_estimator.variance()), sqrt(y_estimator.variance()))
+
+  def goals(self):
+      return dict((obj_name, self.goal(obj_name)) for obj_name in self.coordinates)
 
 
 ###############################################################################
-###############################################################################
-#############################  MAIN BELOW  ####################################
-###############################################################################
+##  Preference store
+##
+##  Learned goal layouts kept in SQLite per user / table profile, so a
+##  returning user can go straight to sorting. EASY profiles keep their
+##  side counts and ADVANCED profiles the number of demos behind each goal,
+##  so new demos are merged into the saved layout instead of replacing it.
 ###############################################################################
 
-def main():
-  try:
-    print ""
-    print "----------------------------------------------------------"
-    print "Welcome to the household Panda!"
-    print "----------------------------------------------------------"
-    print "Press Ctrl-D to exit at any time"
-    print ""
-    print "============ Press `Enter` to begin the service ..."
-    raw_input()
-    DinnerTablePanda = HouseholdPandaArm()
+PREFERENCES_PATH = os.path.expanduser('~/.household_panda.db')
+PROFILE = 'default'
+
+
+class SavedLayout(object):
+  """SavedLayout"""
+  def __init__(self, profile, mode, demos, goals, updated):
+      self.profile = profile
+      self.mode = mode
+      self.demos = demos
+      self.goals = goals
+      self.updated = updated
+
+
+class PreferenceStore(object):
+  """PreferenceStore"""
+  SCHEMA = """
+      CREATE TABLE IF NOT EXISTS profiles (
+          id INTEGER PRIMARY KEY,
+          name TEXT NOT NULL UNIQUE,
+          mode TEXT NOT NULL,
+          demos INTEGER NOT NULL,
+          updated REAL NOT NULL);
+      CREATE TABLE IF NOT EXISTS goals (
+          profile_id INTEGER NOT NULL REFERENCES profiles (id),
+          obj_name TEXT NOT NULL,
+          x REAL NOT NULL,
+          y REAL NOT NULL,
+          demos INTEGER NOT NULL,
+          PRIMARY KEY (profile_id, obj_name));
+      CREATE TABLE IF NOT EXISTS sides (
+          profile_id INTEGER NOT NULL REFERENCES profiles (id),
+          obj_name TEXT NOT NULL,
+          side TEXT NOT NULL,
+          count INTEGER NOT NULL,
+          first_seen INTEGER NOT NULL,
+          PRIMARY KEY (profile_id, obj_name, side));
+      CREATE INDEX IF NOT EXISTS profiles_by_update ON profiles (updated);
+  """
+
+  def __init__(self, path=None):
+      if path is None:
+          path = PREFERENCES_PATH
+      self.path = path
+      self.db = sqlite3.connect(path)
+      self.db.executescript(self.SCHEMA)
+
+  def close(self):
+      self.db.close()
+
+  def load(self, profile):
+      ## The saved layout of `profile`, or None if it has none yet.
+      row = self.db.execute("SELECT id, mode, demos, updated FROM profiles WHERE name = ?",
+                            (profile,)).fetchone()
+      if row is None:
+          return None
+
+      profile_id, mode, demos, updated = row
+      goals = dict((obj_name, (x, y)) for obj_name, x, y in self.db.execute(
+          "SELECT obj_name, x, y FROM goals WHERE profile_id = ?", (profile_id,)))
+      if not goals:
+          return None
+
+      return SavedLayout(profile, mode, demos, goals, updated)
+
+  def profiles(self):
+      # most recently updated first
+      return [name for (name,) in self.db.execute("SELECT name FROM profiles ORDER BY updated DESC")]
+
+  def delete_rows(self, profile_id):
+      self.db.execute("DELETE FROM goals WHERE profile_id = ?", (profile_id,))
+      self.db.execute("DELETE FROM sides WHERE profile_id = ?", (profile_id,))
+      self.db.execute("DELETE FROM profiles WHERE id = ?", (profile_id,))
+
+  def forget(self, profile):
+      with self.db:
+          row = self.db.execute("SELECT id FROM profiles WHERE name = ?", (profile,)).fetchone()
+          if row is not None:
+              self.delete_rows(row[0])
+
+  def update(self, profile, mode, demos, check=None):
+      ## Merges a session's EasyDemos / AdvancedDemos into `profile` in one
+      ## transaction and returns the merged goals. A profile that changes
+      ## mode starts over. If `check` rejects the merged goals nothing is
+      ## saved and ValueError is raised.
+      with self.db:
+          row = self.db.execute("SELECT id, mode, demos FROM profiles WHERE name = ?",
+                                (profile,)).fetchone()
+          if row is not None and row[1] != mode:
+              self.delete_rows(row[0])
+              row = None
+
+          if row is None:
+              cursor = self.db.execute(
+                  "INSERT INTO profiles (name, mode, demos, updated) VALUES (?, ?, 0, ?)",
+                  (profile, mode, time.time()))
+              profile_id, previous = cursor.lastrowid, 0
+          else:
+              profile_id, previous = row[0], row[2]
 
-    rand_nos = []
-    for i in range (6):
-        if i<3:
-            rand_no = (DinnerTablePanda.getRandomFloat('x'))
-            rand_to_float = float("%.2f" % rand_no)
-            #print(rand_to_float)
-            rand_nos.append(rand_to_float)
-        else:
-            rand_no = (DinnerTablePanda.getRandomFloat('y'))
-            rand_to_float = float("%.2f" % rand_no)
-            #print(rand_to_float)
-            rand_nos.append(rand_to_float)
+          if mode == 'EASY':
+              goals = self.merge_sides(profile_id, previous, demos)
+              session = demos.count
+              counts = dict((obj_name, previous + session) for obj_name in goals)
+          else:
+              goals, counts = self.merge_goals(profile_id, demos)
+              session = max(x_estimator.count for x_estimator, y_estimator in demos.coordinates.values())
+          if check is not None and not check(goals):
+              # leaving the block with an exception rolls the merge back
+              raise ValueError("Merged goals for profile '" + profile + "' overlap or are off the table")
+
+          self.db.executemany(
+              "INSERT OR REPLACE INTO goals (profile_id, obj_name, x, y, demos) VALUES (?, ?, ?, ?, ?)",
+              [(profile_id, obj_name, xy[0], xy[1], counts[obj_name]) for obj_name, xy in goals.items()])
+          self.db.execute("UPDATE profiles SET demos = demos + ?, updated = ? WHERE id = ?",
+                          (session, time.time(), profile_id))
+
+      return goals
+
+  def merge_sides(self, profile_id, previous, demos):
+      # side counts add up; ties still go to the side demonstrated first
+      for obj_name, counts in demos.sides.items():
+          for side, count in counts.items():
+              self.db.execute(
+                  "INSERT OR IGNORE INTO sides (profile_id, obj_name, side, count, first_seen) "
+                  "VALUES (?, ?, ?, 0, ?)",
+                  (profile_id, obj_name, side, previous + demos.first_seen[(obj_name, side)]))
+              self.db.execute(
+                  "UPDATE sides SET count = count + ? WHERE profile_id = ? AND obj_name = ? AND side = ?",
+                  (count, profile_id, obj_name, side))
+
+      best = {}
+      for obj_name, side in self.db.execute(
+              "SELECT obj_name, side FROM sides WHERE profile_id = ? ORDER BY count DESC, first_seen",
+              (profile_id,)):
+          best.setdefault(obj_name, side)
+
+      return easy_goals(best["knife"], best["fork"])
+
+  def merge_goals(self, profile_id, demos):
+      # saved and new goals weighted by the number of demos behind them
+      goals = {}
+      counts = {}
+      for obj_name, (x_estimator, y_estimator) in demos.coordinates.items():
+          x, y = demos.goal(obj_name)
+          n = x_estimator.count
+          row = self.db.execute("SELECT x, y, demos FROM goals WHERE profile_id = ? AND obj_name = ?",
+                                (profile_id, obj_name)).fetchone()
+          if row is not None:
+              saved_x, saved_y, saved_n = row
+              x = (saved_x * saved_n + x * n) / (saved_n + n)
+              y = (saved_y * saved_n + y * n) / (saved_n + n)
+              n += saved_n
+
+          goals[obj_name] = (float("%.2f" % x) + 0.0, float("%.2f" % y) + 0.0)
+          counts[obj_name] = n
+
+      return goals, counts
+
+
+def run_headless_episode(seed=None, targets=None, backend=None):
+  ## One full sort (layout, scene, rearrangement, finish_move) on the
+  ## simulated backend. Returns the arm, so callers can inspect the
+  ## backend statistics, and whether the objects ended up sorted.
+  if backend is None:
+      backend = SimulatedBackend()
+  if targets is None:
+      targets = DEFAULT_GOALS
+
+  with tracer.span('episode', seed=seed):
+      DinnerTablePanda = HouseholdPandaArm(backend)
+      setup_scene(DinnerTablePanda, seed)
+      objects_sorted = DinnerTablePanda.sort_objects(targets)
+      DinnerTablePanda.finish_move()
+
+  return DinnerTablePanda, objects_sorted
+
+
+class quiet_output(object):
+  """quiet_output"""
+  ## Silences the progress prints while many episodes run back to back.
+  def __enter__(self):
+      self.stdout = sys.stdout
+      sys.stdout = open(os.devnull, 'w')
+
+  def __exit__(self, exc_type, exc_value, traceback):
+      sys.stdout.close()
+      sys.stdout = self.stdout
+      return False
+
+
+def run_headless(episodes=100):
+  sorted_count = 0
+  start = time.time()
+  with quiet_output():
+      for seed in range(episodes):
+          DinnerTablePanda, objects_sorted = run_headless_episode(seed)
+          if objects_sorted:
+              sorted_count += 1
+  elapsed = time.time() - start
+
+  print("{} episodes, {} sorted, {:.2f}s ({:.0f} episodes/s)".format(
+      episodes, sorted_count, elapsed, episodes / elapsed))
 
 
-    # check distance between objects
+###############################################################################
+##  Batch mode
+##
+##  Demonstrations streamed from a JSONL or CSV file, one record at a time,
+##  so files of any size are processed in constant memory. EASY records
+##  give the knife and fork sides:
+##      {"knife": "LEFT", "fork": "RIGHT"}            knife,fork
+##  ADVANCED records give the object coordinates:
+##      {"plate": [0.4, 0], "knife": [0.4, -0.2], "fork": [0.4, 0.2]}
+##      plate_x,plate_y,knife_x,knife_y,fork_x,fork_y
+###############################################################################
 
-    distanced_y = False
+DEMO_OBJECTS = ["plate", "knife", "fork"]
+DEMO_SIDES = ["LEFT", "RIGHT"]
 
 
-    while not distanced_y:
-        if (abs(rand_nos[3] - rand_nos[4]) < 0.1):
-            rand_nos[3] = float("%.2f" % (DinnerTablePanda.getRandomFloat('y')))
-            firstCheck = False
-        else:
-            firstCheck = True
-        if (abs(rand_nos[3] - rand_nos[5]) < 0.1):
-            rand_nos[5] = float("%.2f" % (DinnerTablePanda.getRandomFloat('y')))
-            secondCheck = False
-        else:
-            secondCheck = True
-        if (abs(rand_nos[4] - rand_nos[5]) < 0.1):
-            rand_nos[4] = float("%.2f" % (DinnerTablePanda.getRandomFloat('y')))
-            firstCheck = False
-            secondCheck = False
-        else:
-            thirdCheck = True
+def read_demo_records(path):
+  ## One dict per line / row; None for lines that are not valid JSON.
+  ## '-' reads JSONL from stdin.
+  if path == '-':
+      f = sys.stdin
+  else:
+      f = open(path)
 
-        if firstCheck and secondCheck and thirdCheck:
-            distanced_y = True
+  try:
+      if path.lower().endswith('.csv'):
+          for row in csv.DictReader(f):
+              yield row
+      else:
+          for line in f:
+              line = line.strip()
+              if not line:
+                  continue
+              try:
+                  yield json.loads(line)
+              except ValueError:
+                  yield None
+  finally:
+      if f is not sys.stdin:
+          f.close()
+
+
+def record_xy(record, obj_name):
+  # [x, y] in JSON, or obj_x / obj_y columns
+  if obj_name in record and isinstance(record[obj_name], (list, tuple)) and len(record[obj_name]) == 2:
+      x, y = record[obj_name]
+  elif record.get(obj_name + '_x') not in (None, '') and record.get(obj_name + '_y') not in (None, ''):
+      x, y = record[obj_name + '_x'], record[obj_name + '_y']
+  else:
+      return None
+
+  return (float("%.2f" % float(x)), float("%.2f" % float(y)))
+
+
+def parse_demo(record):
+  ## ('EASY', (knife side, fork side)), ('ADVANCED', {object: (x, y)}) or
+  ## None if the record is not a usable demo.
+  if not isinstance(record, dict):
+      return None
+
+  knife_side = record.get('knife')
+  fork_side = record.get('fork')
+  if isinstance(knife_side, basestring) and isinstance(fork_side, basestring):
+      knife_side = knife_side.strip().upper()
+      fork_side = fork_side.strip().upper()
+      if knife_side in DEMO_SIDES and fork_side in DEMO_SIDES:
+          return ('EASY', (knife_side, fork_side))
+
+  coordinates = {}
+  try:
+      for obj_name in DEMO_OBJECTS:
+          xy = record_xy(record, obj_name)
+          if xy is None:
+              return None
+          coordinates[obj_name] = xy
+  except (TypeError, ValueError):
+      return None
+
+  return ('ADVANCED', coordinates)
+
+
+def collect_demos(demos):
+  ## Feeds parsed demos into the tally for their mode, which is set by
+  ## the first usable one. Returns (mode, tally, demos used, rejected).
+  mode = None
+  tally = None
+  used = 0
+  rejected = 0
+
+  for demo in demos:
+      if demo is None or (mode is not None and demo[0] != mode):
+          rejected += 1
+          continue
+      if mode is None:
+          mode = demo[0]
+          if mode == 'EASY':
+              tally = EasyDemos()
+          else:
+              tally = AdvancedDemos()
 
-    # objects are now in random positions, adequately spaced apart.
+      if mode == 'EASY':
+          tally.add(*demo[1])
+      else:
+          for obj_name, xy in demo[1].items():
+              tally.add(obj_name, xy)
+      used += 1
+
+  return mode, tally, used, rejected
+
+
+def run_batch(path, dry_run=False, simulated=False, profile=None):
+  ## Goals from the demos in `path`, then the sort, without any prompts.
+  ## The robot connects in the background while the file is read. With a
+  ## `profile` the demos are merged into its saved layout (not on a dry
+  ## run), and the merged goals are sorted to.
+  if dry_run or simulated:
+      DinnerTablePanda = HouseholdPandaArm(SimulatedBackend())
+  else:
+      DinnerTablePanda = HouseholdPandaArm(lazy=True)
+
+  start = time.time()
+  mode, tally, used, rejected = collect_demos(parse_demo(record) for record in read_demo_records(path))
+  elapsed = time.time() - start
+  print("{} demos read from {} in {:.2f}s, {} rejected".format(used, path, elapsed, rejected))
+  if mode is None:
+      print("========== NO USABLE DEMOS ==========")
+      return False
+
+  targets = tally.goals()
+  if profile is not None and not dry_run:
+      store = PreferenceStore()
+      try:
+          targets = store.update(profile, mode, tally, check=DinnerTablePanda.goals_on_table)
+          print("Saved to profile '{}' ({} demos)".format(profile, store.load(profile).demos))
+      except ValueError as e:
+          print("ERROR - " + str(e) + ", profile not saved")
+          return False
+      finally:
+          store.close()
+  print(mode + " MODE goals:")
+  for obj_name in DEMO_OBJECTS:
+      if mode == 'ADVANCED':
+          print("  {:<6} {}  {} of {} demos, spread {:.3f} / {:.3f}".format(
+              obj_name, targets[obj_name], tally.estimator, used, *tally.spread(obj_name)))
+      else:
+          print("  {:<6} {}".format(obj_name, targets[obj_name]))
+  if not DinnerTablePanda.goals_on_table(targets):
+      print("ERROR - DEMOS GIVE OVERLAPPING GOALS OR GOALS OFF THE TABLE")
+      return False
+  if dry_run:
+      return True
+
+  setup_scene(DinnerTablePanda)
+  objects_sorted = DinnerTablePanda.sort_objects(targets)
+  if objects_sorted:
+      print("========== SORTED! ==========")
+      DinnerTablePanda.finish_move()
+  else:
+      print("========== COULD NOT SORT ==========")
+
+  return objects_sorted
+
+
+def canonical_positions():
+  # every EASY-mode goal, plus the default goals
+  positions = set(DEFAULT_GOALS.values())
+  for knife_side in DEMO_SIDES:
+      for fork_side in DEMO_SIDES:
+          positions.update(easy_goals(knife_side, fork_side).values())
+  return sorted(positions)
+
+
+def build_trajectory_library(path, backend=None):
+  ## Plans every leg between canonical poses once, in a scene with only
+  ## the table, and saves them as a trajectory library: the approach and
+  ## the carrying leg from the ready pose and from each canonical position
+  ## to every other one, and the way home from each. The legs from a
+  ## canonical position start from the predicted state at the end of the
+  ## leg that gets there.
+  DinnerTablePanda = HouseholdPandaArm(backend)
+  with DinnerTablePanda.scene_batch() as batch:
+      batch.add_box(DinnerTablePanda.table_name,
+                    (DinnerTablePanda.table_x, DinnerTablePanda.table_y, DinnerTablePanda.table_z),
+                    (DinnerTablePanda.table_size_x, DinnerTablePanda.table_size_y, DinnerTablePanda.table_size_z))
+
+  move_group = DinnerTablePanda.move_group
+  joint_names = move_group.get_active_joints() if hasattr(move_group, 'get_active_joints') else SIM_JOINT_NAMES
+  library = TrajectoryLibrary()
+  start = time.time()
+
+  def plan_leg(start_pose, start_state, waypoints, obj_attached):
+      if start_state is not None:
+          move_group.set_start_state(start_state)
+      try:
+          (plan, fraction) = move_group.compute_cartesian_path(waypoints, EEF_STEP, JUMP_THRESHOLD, True)
+      finally:
+          move_group.set_start_state_to_current_state()
+      if fraction < 1.0:
+          return None
+      library.record(plan_cache.make_key(start_pose, waypoints, EEF_STEP, obj_attached), plan, joint_names)
+      return plan
+
+  ready = DinnerTablePanda.pose_tracker.pose()
+  positions = canonical_positions()
+  arrivals = {}
+  for xy in positions:
+      for obj_attached in [False, True]:
+          plan = plan_leg(ready, None, set_waypoints(DinnerTablePanda, move_group, xy, obj_attached, ready),
+                          obj_attached)
+          if not obj_attached and plan is not None:
+              arrivals[xy] = plan
+
+  for xy, arrival in arrivals.items():
+      start_pose = copy.deepcopy(ready)
+      start_pose.position.x = xy[0]
+      start_pose.position.y = xy[1]
+      start_pose.position.z = DinnerTablePanda.z_coordinate_above_obj
+      start_state = DinnerTablePanda.backend.predicted_start_state(DinnerTablePanda, arrival)
+
+      for other in positions:
+          if other != xy:
+              for obj_attached in [False, True]:
+                  plan_leg(start_pose, start_state,
+                           set_waypoints(DinnerTablePanda, move_group, other, obj_attached, start_pose), obj_attached)
+      plan_leg(start_pose, start_state, DinnerTablePanda.home_waypoints(start_pose), False)
+
+  library.save(path)
+  points = sum(len(rows) for key, rows, attached in library.recorded)
+  print("{} legs, {} points planned in {:.2f}s and saved to {}".format(
+      len(library.recorded), points, time.time() - start, path))
 
 
+###############################################################################
+##  Multi-arm orchestration
+##
+##  A scheduler hands table-setting jobs to arm workers, one process per
+##  arm, each with its own ROS namespace or simulated backend. Workers pull
+##  the next job as soon as they are free, so a slow table never holds up
+##  the others. With --serve the job and result queues are also offered on
+##  the network, and --join starts more workers on another machine.
+##  A job is a dict:
+##      {"id": "table-3", "seed": 3, "goals": {"plate": [0.4, 0], ...}}
+##  with "profile" instead of "goals" for a saved layout.
+###############################################################################
 
+# environment variable holding the shared secret of the network queues.
+# The queues pass pickles, so there is no default: --join needs it set and
+# --serve makes up a random one when it is not.
+AUTHKEY_VARIABLE = 'PANDA_AUTHKEY'
+
+
+def orchestrator_authkey(generate=False):
+  authkey = os.environ.get(AUTHKEY_VARIABLE)
+  if not authkey and generate:
+      authkey = os.urandom(16).encode('hex')
+      print("No " + AUTHKEY_VARIABLE + " set, workers can join with " + AUTHKEY_VARIABLE + "=" + authkey)
+  return authkey
+
+
+class SchedulerManager(BaseManager):
+  """SchedulerManager"""
+  pass
+
+
+def read_jobs(spec):
+  ## Jobs from a JSONL file, or `spec` seeded jobs with the default goals.
+  if spec.isdigit():
+      return [{'id': k, 'seed': k} for k in range(int(spec))]
+
+  jobs = []
+  with open(spec) as f:
+      for line in f:
+          line = line.strip()
+          if line:
+              job = json.loads(line)
+              job.setdefault('id', len(jobs))
+              jobs.append(job)
+  return jobs
+
+
+def resolve_goals(jobs):
+  # saved layouts are looked up once here, workers never open the store
+  store = None
+  for job in jobs:
+      if 'profile' in job and 'goals' not in job:
+          if store is None:
+              store = PreferenceStore()
+          saved = store.load(job['profile'])
+          if saved is not None:
+              job['goals'] = saved.goals
+  if store is not None:
+      store.close()
+
+
+def run_setting_job(job, backend=None):
+  ## One table: the scene from the job's seed, then the sort. A ROS
+  ## backend is shared by the jobs of a worker, a simulated one is new for
+  ## every job.
+  if backend is None:
+      backend = SimulatedBackend(time_scale=job.get('time_scale', 0.0))
+  targets = dict((obj_name, tuple(xy)) for obj_name, xy in job.get('goals', DEFAULT_GOALS).items())
+
+  start = time.time()
+  DinnerTablePanda = HouseholdPandaArm(backend)
+  if not DinnerTablePanda.goals_on_table(targets):
+      return {'sorted': False, 'error': 'goals overlap or are off the table'}
+
+  setup_scene(DinnerTablePanda, job.get('seed'))
+  objects_sorted = DinnerTablePanda.sort_objects(targets)
+  if objects_sorted:
+      DinnerTablePanda.finish_move()
+
+  result = {'sorted': objects_sorted, 'wall_time': time.time() - start}
+  if isinstance(backend, SimulatedBackend):
+      result['motion_time'] = backend.stats.motion_time
+      result['moves'] = backend.stats.picks
+  return result
+
+
+def arm_worker(worker, namespace, jobs, results):
+  ## Worker process: one arm, jobs off the queue until a None.
+  backend = MoveItBackend(namespace) if namespace is not None else None
+  results.put(('joined', worker, None, None))
+
+  while True:
+      job = jobs.get()
+      if job is None:
+          break
+
+      results.put(('started', worker, job['id'], None))
+      try:
+          with quiet_output():
+              result = run_setting_job(job, backend)
+      except Exception as e:
+          result = {'sorted': False, 'error': repr(e)}
+      results.put(('done', worker, job['id'], result))
+
+
+def start_workers(count, namespaces, jobs, results, prefix=''):
+  # one process per namespace, or `count` simulated arms
+  if namespaces:
+      arms = [(prefix + ns.strip('/'), ns) for ns in namespaces]
+  else:
+      arms = [(prefix + 'sim-%d' % k, None) for k in range(count)]
+
+  processes = {}
+  for worker, namespace in arms:
+      process = multiprocessing.Process(target=arm_worker, args=(worker, namespace, jobs, results))
+      process.daemon = True
+      process.start()
+      processes[worker] = process
+  return processes
+
+
+def parse_address(address):
+  host, port = address.rsplit(':', 1)
+  return (host, int(port))
+
+
+def run_orchestrator(jobs, workers=None, namespaces=None, address=None, time_scale=0.0):
+  ## Runs `jobs` on the local workers (plus any that --join `address`) and
+  ## returns job id -> result. A job whose local worker dies is put back
+  ## on the queue for another one.
+  if workers is None:
+      workers = multiprocessing.cpu_count()
+  resolve_goals(jobs)
+  for job in jobs:
+      job.setdefault('time_scale', time_scale)
+
+  manager = None
+  if address is not None:
+      job_queue = Queue.Queue()
+      result_queue = Queue.Queue()
+      SchedulerManager.register('jobs', callable=lambda: job_queue)
+      SchedulerManager.register('results', callable=lambda: result_queue)
+      manager = SchedulerManager(address=parse_address(address), authkey=orchestrator_authkey(generate=True))
+      manager.start()
+      job_queue = manager.jobs()
+      result_queue = manager.results()
+  else:
+      job_queue = multiprocessing.Queue()
+      result_queue = multiprocessing.Queue()
+
+  by_id = dict((job['id'], job) for job in jobs)
+  for job in jobs:
+      job_queue.put(job)
+  processes = start_workers(workers, namespaces, job_queue, result_queue)
+
+  joined = set()
+  running = {}
+  results = OrderedDict()
+  try:
+      while len(results) < len(jobs):
+          try:
+              kind, worker, job_id, result = result_queue.get(timeout=1.0)
+          except Queue.Empty:
+              for worker, process in processes.items():
+                  if not process.is_alive() and worker in running:
+                      job_id = running.pop(worker)
+                      print("Worker " + worker + " died, requeueing job " + str(job_id))
+                      job_queue.put(by_id[job_id])
+              if address is None and not any(process.is_alive() for process in processes.values()):
+                  raise RuntimeError("all workers have died")
+              continue
+
+          if kind == 'joined':
+              joined.add(worker)
+          elif kind == 'started':
+              running[worker] = job_id
+          elif job_id not in results:
+              running.pop(worker, None)
+              result['worker'] = worker
+              results[job_id] = result
+  finally:
+      # a None for every worker that joined, then let them finish
+      for worker in joined:
+          job_queue.put(None)
+      for process in processes.values():
+          process.join(5.0)
+      if manager is not None:
+          manager.shutdown()
+
+  return results
+
+
+def join_orchestrator(address, workers=None, namespaces=None):
+  ## Workers on this machine for the scheduler serving at `address`.
+  authkey = orchestrator_authkey()
+  if not authkey:
+      print("ERROR - set " + AUTHKEY_VARIABLE + " to the key the scheduler was started with")
+      return False
+  if workers is None:
+      workers = multiprocessing.cpu_count()
+  SchedulerManager.register('jobs')
+  SchedulerManager.register('results')
+  manager = SchedulerManager(address=parse_address(address), authkey=authkey)
+  manager.connect()
+
+  prefix = os.uname()[1] + '/'
+  processes = start_workers(workers, namespaces, manager.jobs(), manager.results(), prefix)
+  for process in processes.values():
+      process.join()
+
+  return True
+
+
+def orchestrate(spec, workers=None, namespaces=None, address=None, time_scale=0.0, results_path=None):
+  jobs = read_jobs(spec)
+  start = time.time()
+  results = run_orchestrator(jobs, workers, namespaces, address, time_scale)
+  elapsed = time.time() - start
+
+  per_worker = Counter(result['worker'] for result in results.values())
+  sorted_count = sum(1 for result in results.values() if result['sorted'])
+  print("{} jobs, {} sorted, {:.2f}s ({:.1f} jobs/s)".format(
+      len(jobs), sorted_count, elapsed, len(jobs) / elapsed))
+  for worker, count in sorted(per_worker.items()):
+      print("  {:<12} {} jobs".format(worker, count))
+  for job_id, result in results.items():
+      if 'error' in result:
+          print("  job {}: {}".format(job_id, result['error']))
+
+  if results_path is not None:
+      with open(results_path, 'w') as f:
+          for job_id, result in results.items():
+              result['id'] = job_id
+              f.write(json.dumps(result) + "\n")
+
+  return sorted_count == len(jobs)
+
+
+def benchmark_startup(connect_time=3.0, think_time=2.0):
+  ## Time to the end of the first motion with the connection made up
+  ## front and in the background, on a simulated arm that takes
+  ## `connect_time` to connect and a user who takes `think_time` to
+  ## enter the demos.
+  load_start = time.time()
+  try:
+      load_ros()
+      print("ROS / MoveIt imports: {:.2f}s".format(time.time() - load_start))
+  except ImportError:
+      print("ROS / MoveIt not installed, measuring the simulated arm only")
+
+  for lazy in [False, True]:
+      with quiet_output():
+          plan_cache.invalidate()
+          start = time.time()
+          DinnerTablePanda = HouseholdPandaArm(SimulatedBackend(connect_time=connect_time), lazy=lazy)
+          setup_scene(DinnerTablePanda, 0)
+          time.sleep(think_time)
+          obj_name = DinnerTablePanda.plate_name
+          DinnerTablePanda.check_object(obj_name, (0.0, 0.0), False)
+          first_motion = time.time() - start
+
+      if lazy:
+          mode = 'lazy'
+      else:
+          mode = 'eager'
+      print("{:<6} first motion after {:.2f}s".format(mode, first_motion))
+
+
+def benchmark_pipeline(episodes=5, planning_time=2.0, time_scale=0.05):
+  ## Wall time of the same episodes run leg by leg and pipelined, on a
+  ## simulated arm where each planning call takes `planning_time` and
+  ## everything runs at `time_scale` of real time.
+  global MOTION_MODE
+  motion_mode = MOTION_MODE
+
+  for mode in ['legs', 'pipelined']:
+      MOTION_MODE = mode
+      wall_time = 0.0
+      planning = 0.0
+      motion = 0.0
+      with quiet_output():
+          for seed in range(episodes):
+              plan_cache.invalidate()
+              backend = SimulatedBackend(SimTiming(planning_time=planning_time), time_scale)
+              start = time.time()
+              run_headless_episode(seed, backend=backend)
+              wall_time += time.time() - start
+              planning += backend.stats.planning_calls * planning_time * time_scale
+              motion += backend.stats.motion_time * time_scale
+
+      print("{:<10} {:.2f}s per episode  (planning {:.2f}s + motion {:.2f}s)".format(
+          mode, wall_time / episodes, planning / episodes, motion / episodes))
+
+  MOTION_MODE = motion_mode
 
-    # initiailise object characteristics
-    table_name = DinnerTablePanda.table_name
-    table_coordinates = (DinnerTablePanda.table_x, DinnerTablePanda.table_y, DinnerTablePanda.table_z)
-    table_dimensions = (DinnerTablePanda.table_size_x, DinnerTablePanda.table_size_y, DinnerTablePanda.table_size_z)
 
-    plate_name = DinnerTablePanda.plate_name
-    random_plate_coordinates = (rand_nos[0], rand_nos[3], DinnerTablePanda.plate_z)
-    plate_dimensions = (DinnerTablePanda.plate_size_x, DinnerTablePanda.plate_size_y, DinnerTablePanda.plate_size_z)
+###############################################################################
+##  Episode benchmark
+##
+##  Seeded sort episodes on the simulated backend. The same seeds give the
+##  same layouts and goals, so every metric except wall_time is
+##  deterministic and any change in it comes from the code under test.
+###############################################################################
 
-    knife_name = DinnerTablePanda.knife_name
-    random_knife_coordinates = (rand_nos[1], rand_nos[4], DinnerTablePanda.knife_z)
-    knife_dimensions = (DinnerTablePanda.knife_size_x, DinnerTablePanda.knife_size_y, DinnerTablePanda.knife_size_z)
+BENCHMARK_METRICS = ['wall_time', 'planning_calls', 'retries', 'path_length', 'motion_time', 'moves',
+                     'pose_queries']
+BENCHMARK_PERCENTILES = [50, 90, 99]
+
+
+def benchmark_goal_sets(mode, episodes, seed=0):
+  ## One goal set per episode. EASY cycles through the four LEFT / RIGHT
+  ## combinations, ADVANCED uses random non-overlapping coordinates rounded
+  ## like typed-in ones.
+  if mode == 'EASY':
+      sides = [("LEFT", "RIGHT"), ("RIGHT", "LEFT"), ("LEFT", "LEFT"), ("RIGHT", "RIGHT")]
+      return [easy_goals(*sides[k % len(sides)]) for k in range(episodes)]
+
+  DinnerTablePanda = HouseholdPandaArm(SimulatedBackend())
+  goal_sets = []
+  for k in range(episodes):
+      layout = DinnerTablePanda.random_layout(list(DinnerTablePanda.objects), seed + 10000 + k)
+      goal_sets.append(dict((obj_name, (float("%.2f" % x), float("%.2f" % y)))
+                            for obj_name, (x, y) in layout.items()))
+  return goal_sets
+
+
+def run_benchmark_episode(seed, targets):
+  # every episode starts with an empty plan cache so they are independent
+  plan_cache.invalidate()
+  backend = SimulatedBackend()
+  DinnerTablePanda = HouseholdPandaArm(backend)
+  setup_scene(DinnerTablePanda, seed)
+
+  start = time.time()
+  with tracer.span('episode', seed=seed):
+      objects_sorted = DinnerTablePanda.sort_objects(targets)
+      DinnerTablePanda.finish_move()
+  wall_time = time.time() - start
+
+  stats = backend.stats
+  return {
+      'sorted': objects_sorted,
+      'wall_time': wall_time,
+      'planning_calls': stats.planning_calls,
+      'retries': stats.partial_plans,
+      'path_length': stats.path_length,
+      'motion_time': stats.motion_time,
+      'moves': stats.picks,
+      'pose_queries': stats.pose_queries,
+  }
+
+
+def summarize(values):
+  values = np.asarray(values, dtype=float)
+  summary = {'mean': float(values.mean()), 'max': float(values.max())}
+  for q in BENCHMARK_PERCENTILES:
+      summary['p%d' % q] = float(np.percentile(values, q))
+
+  return summary
+
+
+def run_benchmark(episodes=50, seed=0):
+  ## Runs `episodes` seeded episodes per mode and returns the report:
+  ## mode -> {'episodes', 'sorted', metric -> percentile summary}
+  report = OrderedDict()
+  for mode in ['EASY', 'ADVANCED']:
+      goal_sets = benchmark_goal_sets(mode, episodes, seed)
+      results = []
+      with quiet_output():
+          for k in range(episodes):
+              results.append(run_benchmark_episode(seed + k, goal_sets[k]))
+
+      mode_report = OrderedDict()
+      mode_report['episodes'] = episodes
+      mode_report['sorted'] = sum(1 for result in results if result['sorted'])
+      for metric in BENCHMARK_METRICS:
+          mode_report[metric] = summarize([result[metric] for result in results])
+      report[mode] = mode_report
+
+  return report
+
+
+def compare_benchmarks(report, baseline, tolerance=0.1, wall_time_tolerance=0.25):
+  ## Lines describing every p50 / p90 / mean that got worse than the
+  ## baseline by more than `tolerance` (relative). wall_time is noisy and
+  ## gets its own, looser tolerance; the other metrics are exact for the
+  ## same seeds.
+  regressions = []
+  for mode, mode_report in report.items():
+      if mode not in baseline:
+          continue
+      if mode_report['sorted'] < baseline[mode]['sorted']:
+          regressions.append("{} sorted {} -> {}".format(mode, baseline[mode]['sorted'], mode_report['sorted']))
+      for metric in BENCHMARK_METRICS:
+          if metric not in baseline[mode]:
+              # baseline saved before the metric existed
+              continue
+          if metric == 'wall_time':
+              limit = wall_time_tolerance
+          else:
+              limit = tolerance
+          for stat in ['mean', 'p50', 'p90']:
+              old = baseline[mode][metric][stat]
+              new = mode_report[metric][stat]
+              if new > old * (1 + limit) + 1e-9:
+                  regressions.append("{} {} {} {:.4g} -> {:.4g}".format(mode, metric, stat, old, new))
+
+  return regressions
+
+
+def print_benchmark(report, baseline=None):
+  columns = ['mean'] + ['p%d' % q for q in BENCHMARK_PERCENTILES] + ['max']
+  header = "{:<16}".format("metric") + "".join("{:>10}".format(c) for c in columns)
+  if baseline is not None:
+      header += "{:>12}".format("p50 change")
+
+  for mode, mode_report in report.items():
+      print("{} mode: {} episodes, {} sorted".format(mode, mode_report['episodes'], mode_report['sorted']))
+      print(header)
+      for metric in BENCHMARK_METRICS:
+          summary = mode_report[metric]
+          line = "{:<16}".format(metric) + "".join("{:>10.4g}".format(summary[c]) for c in columns)
+          if baseline is not None and metric in baseline.get(mode, {}):
+              old = baseline[mode][metric]['p50']
+              if old:
+                  line += "{:>+11.1f}%".format(100.0 * (summary['p50'] - old) / old)
+              else:
+                  line += "{:>12}".format("-")
+          elif baseline is not None:
+              line += "{:>12}".format("new")
+          print(line)
+      print("")
+
+
+def benchmark_episodes(episodes=50, baseline_path=None, save_path=None):
+  report = run_benchmark(episodes)
+
+  baseline = None
+  if baseline_path is not None:
+      with open(baseline_path) as f:
+          baseline = json.load(f)
+
+  print_benchmark(report, baseline)
+
+  if save_path is not None:
+      with open(save_path, 'w') as f:
+          json.dump(report, f, indent=2)
+      print("Benchmark saved to " + save_path)
+
+  if baseline is not None:
+      regressions = compare_benchmarks(report, baseline)
+      if regressions:
+          print("REGRESSIONS against " + baseline_path + ":")
+          for line in regressions:
+              print("  " + line)
+          return False
+      print("No regressions against " + baseline_path)
 
-    fork_name = DinnerTablePanda.fork_name
-    random_fork_coordinates = (rand_nos[2], rand_nos[5], DinnerTablePanda.fork_z)
-    fork_dimensions = (DinnerTablePanda.fork_size_x, DinnerTablePanda.fork_size_y, DinnerTablePanda.fork_size_z)
+  return True
 
-    #obj_names = [plate_name, knife_name, fork_name]
 
-    #set the initial random positions of the objets
-    DinnerTablePanda.set_coordinates(plate_name, random_plate_coordinates)
-    DinnerTablePanda.set_coordinates(knife_name, random_knife_coordinates)
-    DinnerTablePanda.set_coordinates(fork_name, random_fork_coordinates)
+def export_trace(path):
+  tracer.export(path)
+  print("Trace with " + str(len(tracer.events)) + " spans written to " + path)
+  for name, (count, seconds) in tracer.summary()[:10]:
+      print("  {:<32} {:>6} x {:>9.3f} ms".format(name, count, 1000.0 * seconds / count))
 
 
-    plate_inplace = False
-    knife_inplace = False
-    fork_inplace = False
-    objects_sorted = False
+def option_value(option, default=None):
+  # value following `option` on the command line, if any
+  if option in sys.argv:
+      position = sys.argv.index(option)
+      if position + 1 < len(sys.argv) and not sys.argv[position + 1].startswith('--'):
+          return sys.argv[position + 1]
+  return default
 
 
+def main():
+  try:
+    import inquirer
 
-    print "============ Adding table ..."
-    #raw_input()
-    time.sleep(3)
-    DinnerTablePanda.add_object(table_name, table_coordinates, table_dimensions)
-    time.sleep(1)
+    # connect to the robot in the background while the user is asked
+    # for the demos, the first motion waits for it
+    DinnerTablePanda = HouseholdPandaArm(lazy=True)
 
-    print "============ Adding first object (plate)..."
-    #raw_input()
-    DinnerTablePanda.add_object(plate_name, random_plate_coordinates, plate_dimensions)
-    time.sleep(1)
+    print ""
+    print "----------------------------------------------------------"
+    print "Welcome to the household Panda!"
+    print "----------------------------------------------------------"
+    print "Press Ctrl-D to exit at any time"
+    print ""
+    print "============ Press `Enter` to begin the service ..."
+    raw_input()
 
-    print "============ Adding second object (knife)..."
-    #raw_input()
-    DinnerTablePanda.add_object(knife_name, random_knife_coordinates, knife_dimensions)
-    time.sleep(1)
+    setup_scene(DinnerTablePanda)
+
+    plate_name = DinnerTablePanda.plate_name
+    knife_name = DinnerTablePanda.knife_name
+    fork_name = DinnerTablePanda.fork_name
 
-    print "============ Adding third object (fork)..."
-    #raw_input()
-    DinnerTablePanda.add_object(fork_name, random_fork_coordinates, fork_dimensions)
-    time.sleep(1)
     print ""
     print "============ SCENE READY!"
     print ""
@@ -632,6 +4451,25 @@ def main():
     #DinnerTablePanda.calibrate_arm()
 
 
+    #SAVED LAYOUT
+    store = PreferenceStore()
+    profile = option_value('--profile', PROFILE)
+    saved = store.load(profile)
+    choice = 'START OVER'
+    if saved is not None:
+        print("============ Saved {} MODE layout for '{}' from {} demos".format(
+            saved.mode, profile, saved.demos))
+        use_saved = [
+            inquirer.List('saved',
+                    message="Use saved layout?",
+                    choices=['SORT NOW', 'ADD DEMOS', 'START OVER'],
+                    carousel=True
+                ),
+        ]
+        choice = inquirer.prompt(use_saved)['saved']
+        if choice == 'START OVER':
+            store.forget(profile)
+
     #SELECT MODE
     print "============ EASY MODE configures only if knife and fork"
     print "============= are to the left or right of the plate."
@@ -645,14 +4483,21 @@ def main():
                 carousel=True
             ),
     ]
-    answer = inquirer.prompt(questions)
+    if choice == 'SORT NOW':
+        answer = {'mode': 'SAVED'}
+    else:
+        answer = inquirer.prompt(questions)
+
+    if answer['mode'] == 'SAVED':
+        rightful_plate_coordinates = saved.goals[plate_name]
+        rightful_knife_coordinates = saved.goals[knife_name]
+        rightful_fork_coordinates = saved.goals[fork_name]
 
     #BEGIN EASY MODE
-    if answer['mode'] == 'EASY':
+    elif answer['mode'] == 'EASY':
         print("======================EASY MODE========================")
         rightful_plate_coordinates = (0.4, 0)
-        knife_positions = []
-        fork_positions = []
+        demos = EasyDemos()
 
 
         counter = 1
@@ -682,7 +4527,6 @@ def main():
                     ),
             ]
             knife_answer = inquirer.prompt(knife_pos)
-            knife_positions.append(knife_answer['position'])
 
             fork_pos = [
                 inquirer.List('position',
@@ -692,35 +4536,20 @@ def main():
                     ),
             ]
             fork_answer = inquirer.prompt(fork_pos)
-            fork_positions.append(fork_answer['position'])
+            demos.add(knife_answer['position'], fork_answer['position'])
 
             counter += 1
 
         no_of_demos = counter-1
 
         print("User Demonstration Complete. Number of Demos Provided: " + str(no_of_demos))
-        knife_data = Counter(knife_positions)
-        knife_most_common = max(knife_positions, key=knife_data.get)
-
-        fork_data = Counter(fork_positions)
-        fork_most_common = max(fork_positions, key=fork_data.get)
-
-
-        if knife_most_common == fork_most_common:
-            if knife_most_common == "RIGHT":
-                rightful_fork_coordinates = (0.4, 0.18)
-                rightful_knife_coordinates = (0.4, 0.3)
-            else:
-                rightful_knife_coordinates = (0.4, -0.18)
-                rightful_fork_coordinates = (0.4, -0.3)
-
-        else:
-            if knife_most_common == "RIGHT":
-                rightful_knife_coordinates = (0.4, 0.2)
-                rightful_fork_coordinates = (0.4, -0.2)
-            else:
-                rightful_knife_coordinates = (0.4, -0.2)
-                rightful_fork_coordinates = (0.4, 0.2)
+        try:
+            goals = store.update(profile, 'EASY', demos, check=DinnerTablePanda.goals_on_table)
+        except ValueError as e:
+            print("ERROR - " + str(e) + ", using this session's demos only")
+            goals = demos.goals()
+        rightful_knife_coordinates = goals[knife_name]
+        rightful_fork_coordinates = goals[fork_name]
     #END EASY MODE
 
     #BEGIN ADVANCED MODE
@@ -740,9 +4569,7 @@ def main():
         good_vals = False
         while not good_vals:
             counter = 1
-            given_plate_coordinates = []
-            given_knife_coordinates = []
-            given_fork_coordinates = []
+            demos = AdvancedDemos()
 
             while(True):
                 if counter == 1:
@@ -779,39 +4606,18 @@ def main():
                         if len(new_list) == 2:
                             user_x_as_float = float(new_list[0])
                             user_y_as_float = float(new_list[1])
-                            user_x_rounded = "%.2f" % user_x_as_float
-                            user_y_rounded = "%.2f" % user_y_as_float
-                            if i == 0:
-                                given_plate_coordinates.append((user_x_rounded, user_y_rounded))
-                            elif i == 1:
-                                given_knife_coordinates.append((user_x_rounded, user_y_rounded))
-                            else:
-                                given_fork_coordinates.append((user_x_rounded, user_y_rounded))
+                            user_x_rounded = float("%.2f" % user_x_as_float)
+                            user_y_rounded = float("%.2f" % user_y_as_float)
+                            demos.add([plate_name, knife_name, fork_name][i], (user_x_rounded, user_y_rounded))
 
 
                 counter += 1
             #END OF USER DEMO
 
             #generate best coordinates for objects, given the user's demos
-            given_coordinates = [given_plate_coordinates, given_knife_coordinates, given_fork_coordinates]
-
-            for j in range(3):
-                obj_list = given_coordinates[j]
-                obj_x_total = 0
-                obj_y_total = 0
-
-                for pair in obj_list:
-                    obj_x_total += float(pair[0])
-                    obj_y_total += float(pair[1])
-                x_avg = float("%.2f" % (obj_x_total / len(obj_list)))
-                y_avg = float("%.2f" % (obj_y_total / len(obj_list)))
-
-                if j == 0:
-                    rightful_plate_coordinates = (x_avg, y_avg)
-                elif j == 1:
-                    rightful_knife_coordinates = (x_avg, y_avg)
-                else:
-                    rightful_fork_coordinates = (x_avg, y_avg)
+            rightful_plate_coordinates = demos.goal(plate_name)
+            rightful_knife_coordinates = demos.goal(knife_name)
+            rightful_fork_coordinates = demos.goal(fork_name)
 
             error_msg1 = "ERROR - ENTER DIFFERENT COORDINATES FOR ALL OBJECTS, WITHIN THE BOUNDARIES"
             error_msg2 = "RESTARTING DEMONSTRATION SESSION NOW"
@@ -850,12 +4656,27 @@ def main():
                     print ""
                     print(error_msg2)
 
+                elif not DinnerTablePanda.reachability.reachable(xy_vals):
+                    bound_check = False
+                    print("ERROR - " + str(xy_vals) + " IS OUT OF THE ARM'S REACH")
+                    print ""
+                    print(error_msg2)
+
             if bound_check:
                 good_vals = True
                 no_of_demos = counter-1
 
                 print("User Demonstration Complete. Number of Demos Provided: " + str(no_of_demos))
 
+                # goals merged with the saved ones, unless they clash
+                try:
+                    goals = store.update(profile, 'ADVANCED', demos, check=DinnerTablePanda.goals_on_table)
+                except ValueError as e:
+                    print("ERROR - " + str(e) + ", using this session's demos only")
+                else:
+                    rightful_plate_coordinates = goals[plate_name]
+                    rightful_knife_coordinates = goals[knife_name]
+                    rightful_fork_coordinates = goals[fork_name]
 
 
     #END ADVANCED MODE
@@ -863,44 +4684,89 @@ def main():
     #SORT OBJECTS
     obj_ids = [plate_name, knife_name, fork_name]
     obj_coordinates = [rightful_plate_coordinates, rightful_knife_coordinates, rightful_fork_coordinates]
-    output_1 = ["plate now", "knife now", "fork now"]
-    output_2 = ["plate done", "knife done", "fork done"]
-
-    while not objects_sorted:
-
-        for k in range(3):
-
-            obj_inplace = DinnerTablePanda.check_object(obj_ids[k], obj_coordinates[k], False)
-            if not obj_inplace:
-                print(output_1[k])
-                DinnerTablePanda.attach_object(obj_ids[k])
-                DinnerTablePanda.try_move_to_goal(obj_ids[k], obj_coordinates[k], True)
-                DinnerTablePanda.detach_object(obj_ids[k])
-            else:
-                print(output_2[k])
-                if k == 0:
-                    plate_inplace = obj_inplace
-                elif k == 1:
-                    knife_inplace = obj_inplace
-                else:
-                    fork_inplace = obj_inplace
-
-        if (plate_inplace and knife_inplace and fork_inplace):
-            objects_sorted = True
-            print("========== SORTED! ==========")
-            DinnerTablePanda.finish_move()
-            sys.exit()
-
-
-
+    targets = dict(zip(obj_ids, obj_coordinates))
 
+    objects_sorted = DinnerTablePanda.sort_objects(targets)
+    if objects_sorted:
+        print("========== SORTED! ==========")
+        DinnerTablePanda.finish_move()
+        sys.exit()
+    else:
+        print("========== COULD NOT SORT ==========")
 
 
 
-  except rospy.ROSInterruptException:
+  except ros_interrupt():
     return
   except KeyboardInterrupt:
     return
 
 if __name__ == '__main__':
-  main()
+  # --trace FILE records spans for the whole run and writes them as a
+  # Chrome trace on exit
+  trace_path = option_value('--trace')
+  if trace_path is not None:
+    tracer.enable()
+  if '--race' in sys.argv:
+    PLANNING_MODE = 'race'
+  if '--stitch' in sys.argv:
+    MOTION_MODE = 'stitched'
+  if '--pipeline' in sys.argv:
+    MOTION_MODE = 'pipelined'
+  GOAL_ESTIMATOR = option_value('--estimator', GOAL_ESTIMATOR)
+  PREFERENCES_PATH = option_value('--preferences', PREFERENCES_PATH)
+  # --retime, with --retime-empty / --retime-carrying VELOCITY,ACCELERATION
+  # scaling for the two profiles
+  retimer.enabled = '--retime' in sys.argv
+  for name in ['empty', 'carrying']:
+    scaling = option_value('--retime-' + name)
+    if scaling is not None:
+      retimer.profiles[name] = tuple(float(v) for v in scaling.split(','))
+  # stored legs, unless benchmarking, which measures planning as it is
+  library_path = option_value('--library', TRAJECTORY_LIBRARY_PATH)
+  if os.path.exists(os.path.join(library_path, 'index.npy')) and \
+      not any(arg.startswith('--bench') for arg in sys.argv):
+    trajectory_library.open(library_path)
+  try:
+    if '--estimator-check' in sys.argv:
+      sys.exit(0 if check_goal_estimators() else 1)
+    elif '--retime-check' in sys.argv:
+      sys.exit(0 if check_retiming(option_value('--retime-check')) else 1)
+    elif '--build-library' in sys.argv:
+      build_trajectory_library(option_value('--build-library', TRAJECTORY_LIBRARY_PATH),
+                               SimulatedBackend() if '--sim' in sys.argv else None)
+    elif '--bench-race' in sys.argv:
+      benchmark_planning_race()
+    elif '--bench-pipeline' in sys.argv:
+      benchmark_pipeline()
+    elif '--bench-startup' in sys.argv:
+      benchmark_startup()
+    elif '--headless' in sys.argv:
+      run_headless(int(option_value('--headless', 100)))
+    elif '--orchestrate' in sys.argv or '--join' in sys.argv:
+      workers = option_value('--workers')
+      if workers is not None:
+        workers = int(workers)
+      namespaces = option_value('--namespaces')
+      if namespaces is not None:
+        namespaces = namespaces.split(',')
+      if '--join' in sys.argv:
+        done = join_orchestrator(option_value('--join'), workers, namespaces)
+        sys.exit(0 if done else 1)
+      else:
+        done = orchestrate(option_value('--orchestrate', '100'), workers, namespaces, option_value('--serve'),
+                           float(option_value('--time-scale', 0.0)), option_value('--results'))
+        sys.exit(0 if done else 1)
+    elif '--demos' in sys.argv:
+      done = run_batch(option_value('--demos'), '--dry-run' in sys.argv, '--sim' in sys.argv,
+                       option_value('--profile'))
+      sys.exit(0 if done else 1)
+    elif '--bench' in sys.argv:
+      passed = benchmark_episodes(int(option_value('--bench', 50)),
+                                  option_value('--baseline'), option_value('--save'))
+      sys.exit(0 if passed else 1)
+    else:
+      main()
+  finally:
+    if trace_path is not None:
+      export_trace(trace_path)